@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+宏处理器回归测试脚本
+
+覆盖宏渲染中曾出现过的问题：
+1. 批量执行时 Python 宏读取到过期的变量快照
+2. datetimeformat 混合使用长短日期记号时被错误拆分
+3. 共享沙盒的对话作用域未随聊天历史刷新
+4. 沙盒代码用 except Exception 吞掉超时异常，死循环无法被打断
+"""
+
+import sys
+import os
+from datetime import datetime
+
+# 确保可以导入项目模块
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.utils.unified_macro_processor import create_unified_macro_processor, _convert_datetimeformat
+from src.utils.python_sandbox import PythonSandbox
+from src.services.macro_manager import MacroManager
+from src.services.data_models import ChatMessage, MessageRole
+
+# 颜色常量
+GREEN = "\033[92m"
+RED = "\033[91m"
+BLUE = "\033[94m"
+RESET = "\033[0m"
+BOLD = "\033[1m"
+
+
+class MacroRegressionTester:
+    """宏处理器回归测试器"""
+
+    def __init__(self):
+        self.passed_tests = 0
+        self.failed_tests = 0
+
+    def check(self, test_name: str, actual: str, expected: str):
+        """比较渲染结果并打印"""
+        if actual == expected:
+            self.passed_tests += 1
+            print(f"{GREEN}✅ {test_name}{RESET}")
+        else:
+            self.failed_tests += 1
+            print(f"{RED}❌ {test_name}{RESET}")
+            print(f"   期望: {expected!r}")
+            print(f"   实际: {actual!r}")
+
+    def test_python_macro_sees_batched_writes(self):
+        """同一内容中先写变量、后用 Python 宏读取时，读到的是写入后的值"""
+        processor = create_unified_macro_processor()
+        global_vars = processor.sandbox.scope_manager.global_vars
+
+        self.check("无旧值时读取 setvar 写入的值",
+                   processor.process_content("{{setvar::global_hp::5}}[{{python:global_hp}}]"),
+                   "[5]")
+
+        global_vars['hp'] = 3
+        self.check("存在旧值时读取 setvar 写入的值",
+                   processor.process_content("{{setvar::global_hp::5}}[{{python:global_hp}}]"),
+                   "[5]")
+
+        global_vars['hp'] = 3
+        self.check("读取前一个 Python 宏写入的值",
+                   processor.process_content("{{python:setvar('global_hp', 7)}}[{{python:global_hp}}]"),
+                   "[7]")
+
+        processor = create_unified_macro_processor(character_data={'name': 'Alice'})
+        self.check("宿主侧读取前一个 Python 宏写入的上下文变量",
+                   processor.process_content("{{python:unified_setvar('char','Z')}}{{char}}"),
+                   "Z")
+
+        processor = create_unified_macro_processor(character_data={'name': 'Alice'})
+        self.check("写入后不复用之前缓存的宿主侧结果",
+                   processor.process_content("{{char}}{{python:unified_setvar('char','Z')}}{{char}}"),
+                   "AliceZ")
+
+    def test_datetimeformat_mixed_tokens(self):
+        """长记号优先匹配（MMMM 不拆成两个 MM），无法识别的字母串原样保留"""
+        now = datetime(2026, 10, 16, 22, 5, 9)
+        cases = [
+            ("dddd, MMMM Do h A", "Friday, October 16th 10 PM"),
+            ("YYYY-MM-DD HH:mm:ss", "2026-10-16 22:05:09"),
+            ("MMM D, YY hh:mm a", "Oct 16, 26 10:05 pm"),
+            ("YYYYMMDD", "20261016"),
+            ("Date: DD/MM", "Date: 16/10"),
+            ("[Today is] dddd", "Today is Friday"),
+            ("%Y-%m-%d", "2026-10-16"),
+        ]
+        for fmt, expected in cases:
+            self.check(f"datetimeformat::{fmt}",
+                       _convert_datetimeformat(fmt, now),
+                       f"result = {expected!r}")
+
+    def test_shared_sandbox_conversation_scope(self):
+        """更新聊天历史后，共享沙盒中的对话信息随之刷新，用户定义的对话变量保留"""
+        sandbox = PythonSandbox()
+        sandbox.init_conversation_scope(chat_history=[], context={})
+        manager = MacroManager({'name': 'Alice'}, {'name': 'Bob'}, shared_sandbox=sandbox)
+        manager.process_string("{{python:setvar('conv_mood', 'calm')}}", 'conversation')
+
+        template = "{{python:conv_message_count}}|{{python:conv_last_user_message}}|{{python:conv_mood}}"
+        self.check("初始对话作用域", manager.process_string(template, 'conversation'), "0||calm")
+
+        manager.update_chat_history([
+            ChatMessage(role=MessageRole.USER, content="你好"),
+            ChatMessage(role=MessageRole.ASSISTANT, content="你好呀"),
+        ])
+        self.check("更新聊天历史后的对话作用域", manager.process_string(template, 'conversation'), "2|你好|calm")
+
+    def test_timeout_not_swallowed(self):
+        """超时信号不继承 Exception，沙盒代码中的 except Exception 无法吞掉它"""
+        sandbox = PythonSandbox(timeout=0.3)
+        code = (
+            "while True:\n"
+            "    try:\n"
+            "        total = sum(range(100000))\n"
+            "    except Exception:\n"
+            "        pass"
+        )
+        result = sandbox.execute_code(code, context_vars={'Exception': Exception})
+        self.check("except Exception 循环超时后终止",
+                   f"{result.success} {result.error}",
+                   "False 代码执行超时 (0.3秒)")
+
+    def run_all_tests(self) -> bool:
+        """运行所有测试"""
+        print(f"{BLUE}{BOLD}宏处理器回归测试{RESET}")
+        self.test_python_macro_sees_batched_writes()
+        self.test_datetimeformat_mixed_tokens()
+        self.test_shared_sandbox_conversation_scope()
+        self.test_timeout_not_swallowed()
+
+        print(f"\n{GREEN}通过: {self.passed_tests}{RESET}")
+        print(f"{RED}失败: {self.failed_tests}{RESET}")
+        return self.failed_tests == 0
+
+
+if __name__ == "__main__":
+    tester = MacroRegressionTester()
+    sys.exit(0 if tester.run_all_tests() else 1)
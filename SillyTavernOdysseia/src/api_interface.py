@@ -61,10 +61,9 @@ class ChatRequest:
             views=data.get('views')
         )
 
-    def to_json(self) -> str:
-        """转换为JSON字符串"""
-        import json
-        return json.dumps({
+    def to_dict(self) -> Dict[str, Any]:
+        """转换为字典（与 to_json 的字段一致）"""
+        return {
             'request_id': self.request_id,
             'character': self.character,
             'persona': self.persona,
@@ -75,7 +74,12 @@ class ChatRequest:
             'assistant_response': self.assistant_response,
             'output_formats': self.output_formats,
             'views': self.views
-        }, ensure_ascii=False, indent=2)
+        }
+    
+    def to_json(self) -> str:
+        """转换为JSON字符串"""
+        import json
+        return json.dumps(self.to_dict(), ensure_ascii=False, indent=2)
     
     def validate(self) -> List[str]:
         """验证输入数据，返回错误信息列表"""
@@ -193,8 +197,7 @@ class ChatResponse:
         
         # 添加原始请求信息
         if self.request is not None:
-            # 使用 to_json 方法，但将其转换为字典
-            response_data['request'] = json.loads(self.request.to_json())
+            response_data['request'] = self.request.to_dict()
         
         return json.dumps(response_data, ensure_ascii=False, indent=2)
     
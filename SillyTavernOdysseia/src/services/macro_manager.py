@@ -33,11 +33,12 @@ class MacroManager:
         self.persona_data = persona_data
         self.chat_history: List[ChatMessage] = []
         
-        # 只使用统一模式
+        # 只使用统一模式（传入共享沙盒时复用，避免重复创建沙盒）
         self._unified_processor: UnifiedMacroProcessor = create_unified_macro_processor(
             character_data=self.character_data,
             persona_data=self.persona_data,
-            chat_history=self.chat_history
+            chat_history=self.chat_history,
+            sandbox=shared_sandbox
         )
 
     def update_chat_history(self, chat_history: List[ChatMessage]):
@@ -45,6 +46,11 @@ class MacroManager:
         self.chat_history = chat_history
         self._unified_processor.update_context(chat_history=chat_history)
 
+        # 共享沙盒的对话作用域只在创建时初始化过一次，历史变化后需同步刷新
+        sandbox = self._unified_processor.sandbox
+        if sandbox:
+            sandbox.update_conversation_history([msg.to_openai_format() for msg in chat_history])
+
     def process_string(self, content: str, scope_type: str = 'temp') -> str:
         """
         处理字符串中的所有宏
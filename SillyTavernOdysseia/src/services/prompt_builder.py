@@ -25,6 +25,13 @@ from .macro_manager import MacroManager
 from .regex_rule_manager import RegexRuleManager
 
 
+# 宏匹配模式（与宏处理器保持一致）
+_MACRO_PATTERN = re.compile(r'\{\{([^{}]*)\}\}')
+# 宏占位符：用Unicode私用区字符包裹序号，不会与正常文本或常见正则规则冲突
+_PLACEHOLDER_TEMPLATE = "\ue000{}\ue001"
+_PLACEHOLDER_PATTERN = re.compile('\ue000(\\d+)\ue001')
+
+
 class PromptBuilder:
     """构建最终提示词的专用类"""
 
@@ -584,17 +591,18 @@ class PromptBuilder:
         if not self.regex_rule_manager or not content:
             return content
             
-        # 1. 找到所有宏
-        macro_pattern = r'\{\{([^{}]*)\}\}'
-        macros = []
-        
-        # 查找所有宏，记录位置和内容
-        for match in re.finditer(macro_pattern, content):
-            macros.append({
-                "start": match.start(),
-                "end": match.end(),
-                "content": match.group(0)
-            })
+        # 1. 找到所有宏，同时在一次遍历中用占位符替换宏
+        macros: List[str] = []
+        parts: List[str] = []
+        last = 0
+        
+        # 不含 `{{` 的内容（绝大多数）无需进入正则扫描
+        if '{{' in content:
+            for i, match in enumerate(_MACRO_PATTERN.finditer(content)):
+                parts.append(content[last:match.start()])
+                parts.append(_PLACEHOLDER_TEMPLATE.format(i))
+                macros.append(match.group(0))
+                last = match.end()
         
         if not macros:
             # 没有宏，直接应用正则
@@ -607,21 +615,9 @@ class PromptBuilder:
                 view=view
             )
         
-        # 2. 用占位符替换宏
-        placeholder_pattern = "___MACRO_PLACEHOLDER_{}_____"
-        result = content
-        offset = 0
-        
-        for i, macro in enumerate(macros):
-            placeholder = placeholder_pattern.format(i)
-            start = macro["start"] + offset
-            end = macro["end"] + offset
-            
-            # 替换宏为占位符
-            result = result[:start] + placeholder + result[end:]
-            
-            # 更新偏移量
-            offset += len(placeholder) - (end - start)
+        # 2. 拼接占位符替换后的内容
+        parts.append(content[last:])
+        result = ''.join(parts)
         
         # 3. 应用正则替换
         result = self.regex_rule_manager.apply_regex_to_content(
@@ -633,12 +629,20 @@ class PromptBuilder:
             view=view
         )
         
-        # 4. 将宏放回
-        for i, macro in enumerate(macros):
-            placeholder = placeholder_pattern.format(i)
-            result = result.replace(placeholder, macro["content"])
-        
-        return result
+        # 4. 将宏放回（一次扫描还原所有占位符，分段拼接）
+        parts = []
+        last = 0
+        for match in _PLACEHOLDER_PATTERN.finditer(result):
+            index = int(match.group(1))
+            if index < len(macros):
+                parts.append(result[last:match.start()])
+                parts.append(macros[index])
+                last = match.end()
+        
+        if not parts:
+            return result  # 占位符已被正则全部移除
+        parts.append(result[last:])
+        return ''.join(parts)
 
     def _apply_regex_before_macro_include(self, content: str, source_type: str, depth: Optional[int] = None, order: Optional[int] = None, view: str = "user_view") -> str:
         """
@@ -16,12 +16,82 @@ from __future__ import annotations
 
 import os
 import json
+import mmap
 import re
 from typing import Any, Dict, List, Optional, Set, Tuple, Union
 from pathlib import Path
 
 from .data_models import RegexRule, ContentPart
 
+try:
+    from re import _parser as sre_parse  # Python 3.11+
+except ImportError:
+    import sre_parse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# 进程级正则编译缓存：find_regex -> 编译后的Pattern
+# API每个请求都会新建RegexRuleManager并重新加载规则，共享缓存可避免重复编译
+_PATTERN_CACHE: Dict[str, "re.Pattern[str]"] = {}
+_PATTERN_CACHE_MAX_SIZE = 1024
+
+
+def _compile_pattern(find_regex: str) -> "re.Pattern[str]":
+    """编译正则表达式，优先复用进程级缓存"""
+    pattern = _PATTERN_CACHE.get(find_regex)
+    if pattern is None:
+        pattern = re.compile(find_regex)
+        if len(_PATTERN_CACHE) >= _PATTERN_CACHE_MAX_SIZE:
+            # 淘汰最早加入的条目
+            del _PATTERN_CACHE[next(iter(_PATTERN_CACHE))]
+        _PATTERN_CACHE[find_regex] = pattern
+    return pattern
+
+
+# 超过该大小的规则文件使用mmap读取，小文件直接read()更快
+_MMAP_THRESHOLD = 64 * 1024
+
+
+def _read_json_file(file_path: Union[str, Path]) -> Any:
+    """
+    以字节方式读取并解析JSON文件
+
+    安装了orjson时直接解析UTF-8字节，大文件通过mmap零拷贝读取；
+    否则回退到标准库json。
+    """
+    with open(file_path, "rb") as f:
+        if orjson is not None and os.fstat(f.fileno()).st_size >= _MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+                return orjson.loads(view)
+        data = f.read()
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+
+def _literal_prefix(find_regex: str) -> str:
+    """
+    提取正则表达式必须匹配的字面量前缀
+
+    任何匹配都必然以该前缀开头，因此内容中不包含该前缀时可以直接跳过规则。
+    无法确定前缀（忽略大小写、分支等）时返回空字符串。
+    """
+    try:
+        parsed = sre_parse.parse(find_regex)
+    except Exception:
+        return ""
+
+    if parsed.state.flags & re.IGNORECASE:
+        return ""
+
+    chars = []
+    for op, av in parsed:
+        if op is not sre_parse.LITERAL:
+            break
+        chars.append(chr(av))
+    return "".join(chars)
 
 class RegexRuleManager:
     """正则表达式规则管理器"""
@@ -34,15 +104,21 @@ class RegexRuleManager:
         
         # 规则被应用后的统计信息
         self.applied_stats: Dict[str, Dict[str, int]] = {}  # rule_id -> {applied_count, matched_count}
+
+        # 按筛选条件缓存的规则应用列表，规则集变化时失效
+        self._bucket_cache: Dict[Tuple, List[Tuple[RegexRule, Any, str, str]]] = {}
         
         # 默认自动加载规则
         if os.path.exists(self.rules_directory):
             self.load_rules()
 
-    def load_rules(self) -> int:
+    def load_rules(self, eager: bool = False) -> int:
         """
         从规则目录加载所有规则文件
         
+        Args:
+            eager: 是否立即编译所有规则（默认在规则首次应用时才编译）
+            
         Returns:
             加载的规则数量
         """
@@ -57,8 +133,7 @@ class RegexRuleManager:
             # 遍历目录中的所有JSON文件
             for file_path in Path(self.rules_directory).glob("*.json"):
                 try:
-                    with open(file_path, "r", encoding="utf-8") as f:
-                        rules_data = json.load(f)
+                    rules_data = _read_json_file(file_path)
                         
                     # 支持单个规则或规则列表
                     if isinstance(rules_data, list):
@@ -73,7 +148,7 @@ class RegexRuleManager:
                     print(f"⚠️ 加载规则文件失败 {file_path}: {e}")
             
             # 重新编译和排序规则
-            self._compile_rules()
+            self._compile_rules(eager)
             self._sort_rules()
             
             print(f"📝 成功加载 {loaded_count} 个正则规则")
@@ -144,26 +219,55 @@ class RegexRuleManager:
         except Exception as e:
             print(f"⚠️ 创建规则失败: {e}")
 
-    def _compile_rules(self) -> None:
-        """编译所有规则的正则表达式"""
+    def _compile_rules(self, eager: bool = False) -> None:
+        """
+        登记所有启用规则的正则表达式
+
+        默认只记录源码，实际编译推迟到规则首次应用时（见 _get_compiled）。
+
+        Args:
+            eager: 是否立即编译所有规则
+        """
         self.compiled_rules = {}
+        self._bucket_cache = {}
         
         for rule in self.rules:
             if not rule.enabled:
                 continue
                 
-            try:
-                compiled_regex = re.compile(rule.find_regex)
-                self.compiled_rules[rule.id] = {
-                    "pattern": compiled_regex,
-                    "replace": rule.replace_regex
-                }
-            except Exception as e:
-                print(f"⚠️ 正则表达式编译失败 [{rule.id}]: {e}")
+            self.compiled_rules[rule.id] = {
+                "source": rule.find_regex,
+                "replace": rule.replace_regex,
+                "pattern": None,
+                "literal": None
+            }
+            if eager:
+                self._get_compiled(rule.id)
+
+    def _get_compiled(self, rule_id: str) -> Optional[Dict[str, Any]]:
+        """
+        获取规则的编译结果，首次访问时才编译
+
+        Returns:
+            编译后的规则条目；规则不存在或编译失败时返回None
+        """
+        entry = self.compiled_rules.get(rule_id)
+        if entry is None or entry["pattern"] is not None:
+            return entry
+
+        try:
+            entry["pattern"] = _compile_pattern(entry["source"])
+            entry["literal"] = _literal_prefix(entry["source"])
+        except Exception as e:
+            print(f"⚠️ 正则表达式编译失败 [{rule_id}]: {e}")
+            del self.compiled_rules[rule_id]
+            return None
+        return entry
 
     def _sort_rules(self) -> None:
         """按targets数量和id排序规则"""
         self.rules.sort(key=lambda r: (len(r.targets), r.id))
+        self._bucket_cache = {}
 
     def add_rule(self, rule: RegexRule) -> bool:
         """
@@ -182,7 +286,7 @@ class RegexRuleManager:
             
         try:
             # 测试编译正则表达式
-            re.compile(rule.find_regex)
+            _compile_pattern(rule.find_regex)
             
             # 添加规则
             self.rules.append(rule)
@@ -213,6 +317,7 @@ class RegexRuleManager:
             # 移除成功，更新编译规则
             if rule_id in self.compiled_rules:
                 del self.compiled_rules[rule_id]
+            self._bucket_cache = {}
             return True
         else:
             print(f"⚠️ 规则不存在: {rule_id}")
@@ -326,25 +431,24 @@ class RegexRuleManager:
         
         # 确定要应用的规则列表
         if rule_to_apply:
-            applicable_rules = [rule_to_apply] if rule_to_apply.enabled else []
+            appliers = self._build_appliers([rule_to_apply] if rule_to_apply.enabled else [])
         else:
             # 筛选适用于当前内容、处理阶段和深度/次序的规则
-            applicable_rules = self._filter_applicable_rules(source_type, depth, order, placement, view)
+            appliers = self._get_bucket_appliers(source_type, depth, order, placement, view)
 
-        if not applicable_rules:
+        if not appliers:
             return content
 
         # 应用规则
-        for rule in applicable_rules:
-            if rule.id not in self.compiled_rules:
+        for rule, sub, replace_pattern, literal in appliers:
+            # 内容中不含必需的字面量前缀时规则不可能匹配，跳过正则扫描
+            if literal and literal not in result:
+                self._update_stats(rule, False)
                 continue
             
             try:
-                compiled_pattern = self.compiled_rules[rule.id]["pattern"]
-                replace_pattern = self.compiled_rules[rule.id]["replace"]
-                
                 before_result = result
-                result = compiled_pattern.sub(replace_pattern, result)
+                result = sub(replace_pattern, result)
                 
                 self._update_stats(rule, before_result != result)
                 
@@ -353,6 +457,26 @@ class RegexRuleManager:
                 
         return result
 
+    def _get_bucket_appliers(self, source_type: str, depth: Optional[int], order: Optional[int], placement: str, view: str) -> List[Tuple[RegexRule, Any, str, str]]:
+        """获取（并缓存）指定筛选条件下的规则应用列表"""
+        key = (source_type, depth, order, placement, view)
+        appliers = self._bucket_cache.get(key)
+        if appliers is None:
+            rules = self._filter_applicable_rules(source_type, depth, order, placement, view)
+            appliers = self._build_appliers(rules)
+            self._bucket_cache[key] = appliers
+        return appliers
+
+    def _build_appliers(self, rules: List[RegexRule]) -> List[Tuple[RegexRule, Any, str, str]]:
+        """将规则预绑定为 (规则, sub方法, 替换模板, 字面量前缀) 元组"""
+        appliers = []
+        for rule in rules:
+            compiled = self._get_compiled(rule.id)
+            if compiled is None:
+                continue
+            appliers.append((rule, compiled["pattern"].sub, compiled["replace"], compiled["literal"]))
+        return appliers
+
     def _filter_applicable_rules(self, source_type: str, depth: Optional[int], order: Optional[int], placement: str, view: str) -> List[RegexRule]:
         """根据条件筛选适用的规则"""
         target = self._map_source_to_target(source_type)
@@ -443,4 +567,5 @@ class RegexRuleManager:
         """清空所有规则"""
         self.rules = []
         self.compiled_rules = {}
+        self._bucket_cache = {}
         self.applied_stats = {}
\ No newline at end of file
@@ -12,11 +12,20 @@ Python沙箱执行引擎
 """
 
 import ast
+import builtins
+import datetime
+import math
+import operator
+import random
+import re
+import signal
 import sys
 import time
 import types
 import threading
-from typing import Any, Dict, List, Optional, Set, Callable
+from collections import OrderedDict
+from functools import lru_cache
+from typing import AbstractSet, Any, Dict, List, Mapping, Optional, Sequence, Callable, Tuple, Union
 from dataclasses import dataclass, field
 from contextlib import contextmanager
 
@@ -36,7 +45,238 @@ class TimeoutError(SandboxError):
     pass
 
 
-@dataclass
+class _ExecutionTimeout(BaseException):
+    """
+    SIGALRM 定时器在执行中的代码里抛出的超时信号
+    
+    不继承 Exception，沙箱代码中的 except Exception 无法吞掉它；
+    只在 execute_code 边界捕获并转换为超时结果。
+    """
+    pass
+
+
+# 对外的作用域名称 -> ScopeManager 中对应的变量字典属性名（顺序即 get_all_variables 的输出顺序）
+_SCOPE_NAME_VARS = {
+    'conversation': 'conversation_vars',
+    'preset': 'preset_vars',
+    'character': 'char_vars',
+    'world': 'world_vars',
+    'global': 'global_vars',
+    'temp': 'temp_vars',
+}
+
+
+# 以前缀形式暴露到执行上下文中的作用域：(键前缀模板, 变量字典属性名, 函数字典属性名)
+_CONTEXT_SCOPE_PREFIXES = (
+    ('conv_{}', 'conversation_vars', 'conversation_funcs'),
+    ('preset_{}', 'preset_vars', 'preset_funcs'),
+    ('char_{}', 'char_vars', 'char_funcs'),
+    ('world_{}', 'world_vars', 'world_funcs'),
+    ('global_{}', 'global_vars', 'global_funcs'),
+)
+
+
+# 当前平台是否支持基于 SIGALRM 的执行超时
+_ALARM_SUPPORTED = hasattr(signal, 'setitimer') and hasattr(signal, 'SIGALRM')
+
+
+# 编译结果缓存的最大条目数
+_CODE_CACHE_MAX_SIZE = 1024
+
+# 可复用的执行结果对象的最大数量
+_RESULT_POOL_MAX_SIZE = 64
+
+
+def _parse_dice_number(text: str) -> Optional[int]:
+    """解析骰子表达式中带可选正负号的整数，格式不合法时返回None"""
+    digits = text[1:] if text[:1] in ('+', '-') else text
+    if not digits.isdigit():
+        return None
+    return int(text)
+
+
+def _legacy_roll(dice_expr: str) -> str:
+    """处理骰子表达式，如 '1d6'、'2D20' """
+    try:
+        count_str, sep, sides_str = dice_expr.lower().partition('d')
+        if not sep:
+            return "1"
+        
+        count_str = count_str.strip()
+        num_dice = _parse_dice_number(count_str) if count_str else 1
+        num_sides = _parse_dice_number(sides_str.strip())
+        if num_dice is None or num_sides is None:
+            return "1"
+        
+        # 限制范围防止滥用
+        num_dice = min(max(num_dice, 1), 20)
+        num_sides = min(max(num_sides, 2), 100)
+        
+        if num_dice == 1:
+            return str(random.randint(1, num_sides))
+        # 多个骰子一次性抽取，避免逐个调用 randint
+        total = sum(random.choices(range(1, num_sides + 1), k=num_dice))
+        return str(total)
+    except (ValueError, TypeError, AttributeError):
+        return "1"
+
+
+def _legacy_random(*choices) -> str:
+    """从选项中随机选择一个"""
+    if not choices:
+        return ""
+    return str(random.choice(choices))
+
+
+def _legacy_pick(*choices) -> str:
+    """从选项中随机选择一个（与legacy_random相同）"""
+    if not choices:
+        return ""
+    return str(random.choice(choices))
+
+
+def _legacy_string_op(operation: str, text: str) -> str:
+    """处理字符串操作"""
+    try:
+        if operation == 'upper':
+            return text.upper()
+        elif operation == 'lower':
+            return text.lower()
+        elif operation == 'length':
+            return str(len(text))
+        elif operation == 'reverse':
+            return text[::-1]
+        else:
+            return text
+    except:
+        return text
+
+
+def _coerce_number(value: Any) -> Union[int, float]:
+    """将宏参数转换为数值：整数保持 int，其余按 float 处理（无法转换时抛出 ValueError/TypeError）"""
+    if isinstance(value, (int, float)):
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+def _format_number(value: Union[int, float]) -> str:
+    """格式化数值结果，整数值不带小数点"""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def _safe_div(a: Union[int, float], b: Union[int, float]) -> Union[int, float]:
+    """除法，除数为0时返回0"""
+    return a / b if b != 0 else 0
+
+
+# 数学运算宏 -> C 实现的二元运算函数（div 除外）
+_MATH_FUNCTIONS: Dict[str, Callable[[Any, Any], Any]] = {
+    'add': operator.add,
+    'sub': operator.sub,
+    'mul': operator.mul,
+    'div': _safe_div,
+    'max': max,
+    'min': min,
+}
+
+
+def _legacy_math_op(operation: str, a: Any, b: Any = 0) -> str:
+    """处理数学运算宏，如 add/sub/mul/div/max/min"""
+    func = _MATH_FUNCTIONS.get(operation)
+    if func is None:
+        return "0"
+    try:
+        return _format_number(func(_coerce_number(a), _coerce_number(b)))
+    except (ValueError, TypeError):
+        return "0"
+
+
+# getvar/setvar 变量名前缀 → ScopeManager 中对应的变量字典属性名
+_VAR_PREFIX_SCOPES = {
+    'world': 'world_vars',
+    'preset': 'preset_vars',
+    'char': 'char_vars',
+    'character': 'char_vars',
+    'conv': 'conversation_vars',
+    'conversation': 'conversation_vars',
+    'global': 'global_vars',
+}
+
+
+# 无前缀变量：当前作用域类型 → ScopeManager 中对应的变量字典属性名（其余作用域使用 global_vars）
+_SCOPE_TYPE_VARS = {
+    'preset': 'preset_vars',
+    'char': 'char_vars',
+    'character': 'char_vars',
+    'world': 'world_vars',
+    'conversation': 'conversation_vars',
+}
+
+
+# 禁止直接调用的内置函数名
+_FORBIDDEN_CALLS = frozenset({'eval', 'exec', 'compile', 'open'})
+
+
+# 源码预检：纯ASCII源码中不出现以下任何片段时，语法树中不可能存在违规节点，可跳过完整遍历
+# （import/del/global/nonlocal 语句、禁止调用的函数名，以及点号后以下划线开头的属性名，
+#  属性名前允许出现空白、续行符和注释）。非ASCII源码中的标识符可能经 NFKC 规范化为下划线，不做预检。
+_UNSAFE_SOURCE_RE = re.compile(r'import|del|global|nonlocal|eval|exec|compile|open|\.(?:\s|\\|#[^\n]*)*_')
+
+
+class _SafetyVisitor(ast.NodeVisitor):
+    """单次遍历AST的安全检查器，按节点类型分派，发现违规立即抛出 SecurityError"""
+    
+    def _forbid(self, node: ast.AST) -> None:
+        raise SecurityError(f"禁止使用: {type(node).__name__}")
+    
+    # 禁止的语句节点（与 PythonSandbox.FORBIDDEN_NODES 对应）
+    visit_Import = visit_ImportFrom = _forbid
+    visit_Delete = visit_Global = visit_Nonlocal = _forbid
+    
+    def visit_Attribute(self, node: ast.Attribute) -> None:
+        # 检查属性访问
+        if node.attr.startswith('_'):
+            raise SecurityError(f"禁止访问私有属性: {node.attr}")
+        self.generic_visit(node)
+    
+    def visit_Call(self, node: ast.Call) -> None:
+        # 检查函数调用
+        func = node.func
+        if isinstance(func, ast.Name) and func.id in _FORBIDDEN_CALLS:
+            raise SecurityError(f"禁止调用: {func.id}")
+        self.generic_visit(node)
+
+
+@lru_cache(maxsize=1024)
+def _split_var_prefix(name: str, default_attr: str) -> Tuple[str, str]:
+    """
+    解析变量名前缀（按第一个下划线前的部分查表）
+    
+    Args:
+        name: 变量名（可带 world_/char_/conv_ 等作用域前缀）
+        default_attr: 无有效前缀时使用的作用域属性名
+        
+    Returns:
+        (目标作用域属性名, 实际变量名)
+    """
+    prefix, separator, actual_name = name.partition('_')
+    if separator:
+        scope_attr = _VAR_PREFIX_SCOPES.get(prefix)
+        if scope_attr is not None:
+            return scope_attr, actual_name
+    return default_attr, name
+
+
+# Python 3.10+ 上为频繁创建的数据类生成 __slots__
+_DATACLASS_SLOTS = {'slots': True} if sys.version_info >= (3, 10) else {}
+
+
+@dataclass(**_DATACLASS_SLOTS)
 class ExecutionResult:
     """执行结果"""
     success: bool
@@ -44,9 +284,19 @@ class ExecutionResult:
     error: Optional[str] = None
     execution_time: float = 0.0
     memory_used: Optional[int] = None
+    
+    def reset(self, success: bool, result: Any = None, error: Optional[str] = None,
+              execution_time: float = 0.0) -> 'ExecutionResult':
+        """重置为新的执行结果（供对象池复用）"""
+        self.success = success
+        self.result = result
+        self.error = error
+        self.execution_time = execution_time
+        self.memory_used = None
+        return self
 
 
-@dataclass 
+@dataclass(**_DATACLASS_SLOTS)
 class ScopeManager:
     """统一作用域管理器"""
     # 所有作用域在同一上下文中
@@ -63,60 +313,123 @@ class ScopeManager:
     temp_vars: Dict[str, Any] = field(default_factory=dict)  # 向后兼容
 
 
+# 沙箱白名单默认用到的标准库模块（已在模块顶部导入，无需再经 __import__ 查找）
+_STDLIB_MODULES = {
+    'random': random,
+    'math': math,
+    'datetime': datetime,
+    're': re,
+}
+
+
+# (名称, 对象) 列表
+_NamedItems = Tuple[Tuple[str, Any], ...]
+
+
+@lru_cache(maxsize=None)
+def _restricted_module_items(module_name: str, allowed_funcs: Tuple[str, ...]) -> _NamedItems:
+    """解析模块中白名单函数的 (函数名, 函数) 列表（相同白名单只解析一次）"""
+    module = _STDLIB_MODULES.get(module_name)
+    if module is None:
+        module = __import__(module_name)
+    return tuple(
+        (func_name, getattr(module, func_name))
+        for func_name in allowed_funcs
+        if hasattr(module, func_name)
+    )
+
+
+def _build_safe_builtins(allowed_builtins: AbstractSet[str],
+                         allowed_modules: Mapping[str, Sequence[str]]
+                         ) -> Tuple[_NamedItems, Tuple[Tuple[str, _NamedItems], ...]]:
+    """
+    解析沙箱可用的内置函数和受限模块
+    
+    Returns:
+        (内置函数的 (名称, 对象) 列表, 受限模块的 (模块名, 白名单函数列表) 列表)
+    """
+    builtin_items = []
+    module_items = []
+    
+    # 添加允许的内置函数
+    for name in allowed_builtins:
+        if hasattr(builtins, name):
+            builtin_items.append((name, getattr(builtins, name)))
+    
+    # 添加受限的模块
+    for module_name, allowed_funcs in allowed_modules.items():
+        try:
+            module_items.append((module_name, _restricted_module_items(module_name, tuple(allowed_funcs))))
+        except ImportError:
+            continue
+    return tuple(builtin_items), tuple(module_items)
+
+
+# 沙箱类 -> 已解析的白名单（内容只取决于类上的白名单，只解析一次）
+# 只缓存解析结果，不缓存字典和模块对象本身：沙箱代码可以修改 __builtins__ 和模块属性，
+# 每个实例必须持有独立的字典和模块对象
+_SAFE_BUILTINS_CACHE: Dict[type, Tuple[_NamedItems, Tuple[Tuple[str, _NamedItems], ...]]] = {}
+
+
 class PythonSandbox:
     """Python沙箱执行器"""
     
     # 允许的内置函数
-    ALLOWED_BUILTINS = {
+    ALLOWED_BUILTINS = frozenset({
         'abs', 'all', 'any', 'bool', 'dict', 'divmod', 'enumerate',
         'filter', 'float', 'int', 'len', 'list', 'map', 'max', 'min',
         'range', 'round', 'sorted', 'str', 'sum', 'tuple', 'zip'
-    }
+    })
     
-    # 允许的模块
-    ALLOWED_MODULES = {
-        'random': ['randint', 'choice', 'random', 'shuffle'],
-        'math': ['sqrt', 'sin', 'cos', 'tan', 'floor', 'ceil'],
-        'datetime': ['datetime', 'date', 'time'],
-        're': ['match', 'search', 'findall', 'sub']
-    }
+    # 允许的模块（只读映射，白名单按类解析后缓存，不应在运行时修改）
+    ALLOWED_MODULES = types.MappingProxyType({
+        'random': ('randint', 'choice', 'random', 'shuffle'),
+        'math': ('sqrt', 'sin', 'cos', 'tan', 'floor', 'ceil'),
+        'datetime': ('datetime', 'date', 'time'),
+        're': ('match', 'search', 'findall', 'sub')
+    })
     
     # 禁止的AST节点类型
-    FORBIDDEN_NODES = {
+    FORBIDDEN_NODES = frozenset({
         ast.Import, ast.ImportFrom,
         ast.Delete, ast.Global, ast.Nonlocal
-    }
+    })
     
     def __init__(self, timeout: float = 5.0, max_iterations: int = 1000):
         self.timeout = timeout
         self.max_iterations = max_iterations
         self.scope_manager = ScopeManager()
+        self.registered_functions: Dict[str, Callable] = {}  # 外部注册的原生函数
+        # 调用方通过 release_result 归还的执行结果，execute_code 优先复用
+        self._result_pool: List[ExecutionResult] = []
+        # 代码的检查/编译结果：(代码, 是否只作为表达式) -> (代码对象, 是否为表达式)，未通过安全检查时为错误信息
+        self._code_cache: 'OrderedDict[Tuple[str, bool], Union[Tuple[types.CodeType, bool], str]]' = OrderedDict()
+        # 执行上下文中不随变量变化的部分（前段/后段原型），注册函数或替换作用域管理器时失效
+        self._context_version = 0
+        self._context_proto_version = -1
+        self._context_proto_scopes: Optional[ScopeManager] = None
+        self._context_head: Dict[str, Any] = {}
+        self._context_tail: Dict[str, Any] = {}
+        # 作用域类型 -> (setvar, getvar)，随上下文原型一起失效
+        self._varfn_cache: Dict[str, Tuple[Callable, Callable]] = {}
         self._setup_safe_builtins()
         self._setup_scope_functions()
     
     def _setup_safe_builtins(self):
-        """设置安全的内置函数"""
-        self.safe_builtins = {}
-        
-        # 添加允许的内置函数
-        import builtins
-        for name in self.ALLOWED_BUILTINS:
-            if hasattr(builtins, name):
-                self.safe_builtins[name] = getattr(builtins, name)
-        
-        # 添加受限的模块
-        for module_name, allowed_funcs in self.ALLOWED_MODULES.items():
-            try:
-                module = __import__(module_name)
-                module_dict = {}
-                for func_name in allowed_funcs:
-                    if hasattr(module, func_name):
-                        module_dict[func_name] = getattr(module, func_name)
-                self.safe_builtins[module_name] = types.ModuleType(module_name)
-                for name, func in module_dict.items():
-                    setattr(self.safe_builtins[module_name], name, func)
-            except ImportError:
-                continue
+        """设置安全的内置函数（白名单按类解析一次，每个实例使用独立的字典和模块对象）"""
+        cls = type(self)
+        whitelist = _SAFE_BUILTINS_CACHE.get(cls)
+        if whitelist is None:
+            whitelist = _SAFE_BUILTINS_CACHE[cls] = _build_safe_builtins(
+                cls.ALLOWED_BUILTINS, cls.ALLOWED_MODULES
+            )
+        builtin_items, module_items = whitelist
+        
+        self.safe_builtins = dict(builtin_items)
+        for module_name, func_items in module_items:
+            module = types.ModuleType(module_name)
+            module.__dict__.update(func_items)
+            self.safe_builtins[module_name] = module
     
     def _setup_scope_functions(self):
         """设置各作用域的getvar/setvar函数"""
@@ -124,35 +437,92 @@ class PythonSandbox:
         # getvar/setvar 会根据变量名前缀自动判断作用域
         pass
     
-    def _validate_code(self, code: str) -> None:
-        """验证代码安全性"""
+    def register_functions(self, functions: Dict[str, Callable]) -> None:
+        """
+        注册原生Python函数，之后每次执行代码时都可直接调用
+        
+        Args:
+            functions: 函数名 -> 函数对象
+        """
+        self.registered_functions.update(functions)
+        self._context_version += 1
+    
+    def _validate_code(self, code: str, mode: str = 'exec') -> ast.AST:
+        """验证代码安全性，返回解析得到的语法树"""
         try:
-            tree = ast.parse(code)
+            tree = ast.parse(code, mode=mode)
         except SyntaxError as e:
             raise SecurityError(f"语法错误: {e}")
         
-        # 检查禁止的节点类型
-        for node in ast.walk(tree):
-            if type(node) in self.FORBIDDEN_NODES:
-                raise SecurityError(f"禁止使用: {type(node).__name__}")
-            
-            # 检查属性访问
-            if isinstance(node, ast.Attribute):
-                if node.attr.startswith('_'):
-                    raise SecurityError(f"禁止访问私有属性: {node.attr}")
-            
-            # 检查函数调用
-            if isinstance(node, ast.Call):
-                if isinstance(node.func, ast.Name):
-                    if node.func.id in ['eval', 'exec', 'compile', 'open']:
-                        raise SecurityError(f"禁止调用: {node.func.id}")
+        # 源码中不含任何可疑片段时无需遍历语法树
+        if code.isascii() and _UNSAFE_SOURCE_RE.search(code) is None:
+            return tree
+        
+        # 检查禁止的节点类型、私有属性访问和危险函数调用
+        _SafetyVisitor().visit(tree)
+        return tree
     
-    def _create_execution_context(self, scope_type: str) -> Dict[str, Any]:
-        """创建统一执行上下文"""
-        context = {
+    def _get_compiled(self, code: str, expression_only: bool = False) -> Tuple[types.CodeType, bool]:
+        """
+        获取代码的编译结果（同一段代码只做一次安全检查和编译，未通过检查的结果同样缓存）
+        
+        Returns:
+            (代码对象, 是否为表达式)
+        
+        Raises:
+            SecurityError: 代码未通过安全检查
+        """
+        key = (code, expression_only)
+        compiled = self._code_cache.get(key)
+        if compiled is not None:
+            # 命中时移到末尾，淘汰时优先移除最久未使用的条目
+            self._code_cache.move_to_end(key)
+            if type(compiled) is str:
+                raise SecurityError(compiled)
+            return compiled
+        
+        # 1. 验证代码安全性
+        try:
+            tree = self._validate_code(code, mode='eval' if expression_only else 'exec')
+        except SecurityError as e:
+            self._store_compiled(key, str(e))
+            raise
+        
+        # 2. 直接编译语法树：只有一条表达式语句时作为表达式编译，否则作为语句编译
+        #    （按语法树形状判断，无需先尝试 eval 编译再捕获 SyntaxError）
+        if expression_only:
+            compiled = (compile(tree, '<sandbox>', 'eval'), True)
+        elif len(tree.body) == 1 and isinstance(tree.body[0], ast.Expr):
+            expression = ast.Expression(body=tree.body[0].value)
+            compiled = (compile(expression, '<sandbox>', 'eval'), True)
+        else:
+            compiled = (compile(tree, '<sandbox>', 'exec'), False)
+        
+        self._store_compiled(key, compiled)
+        return compiled
+    
+    def _store_compiled(self, key: Tuple[str, bool], compiled: Union[Tuple[types.CodeType, bool], str]) -> None:
+        """写入编译结果缓存，已满时淘汰最久未使用的条目"""
+        if len(self._code_cache) >= _CODE_CACHE_MAX_SIZE:
+            self._code_cache.popitem(last=False)
+        self._code_cache[key] = compiled
+    
+    def resolve_variable_scope(self, name: str, scope_type: str) -> Tuple[Dict[str, Any], str]:
+        """
+        确定 getvar/setvar 操作的目标作用域
+        
+        Returns:
+            (目标作用域变量字典, 实际变量名)
+        """
+        # 如果没有前缀或前缀不匹配，使用当前作用域
+        scope_attr, actual_name = _split_var_prefix(name, _SCOPE_TYPE_VARS.get(scope_type, 'global_vars'))
+        return getattr(self.scope_manager, scope_attr), actual_name
+    
+    def _build_context_prototype(self) -> None:
+        """构建执行上下文中与变量内容无关的前段和后段"""
+        self._context_head = {
             '__builtins__': self.safe_builtins,
             'enable': True,  # 保留变量
-            'current_scope': scope_type,
             
             # 所有作用域都可互相访问
             'conversation_vars': self.scope_manager.conversation_vars,
@@ -168,105 +538,79 @@ class PythonSandbox:
             'temp_vars': self.scope_manager.temp_vars,  # 向后兼容
         }
         
-        # 将变量按作用域添加到上下文中，使用前缀区分
-        # 添加带前缀的变量
-        for name, value in self.scope_manager.conversation_vars.items():
-            context[f"conv_{name}"] = value
-        for name, value in self.scope_manager.preset_vars.items():
-            context[f"preset_{name}"] = value
-        for name, value in self.scope_manager.char_vars.items():
-            context[f"char_{name}"] = value
-        for name, value in self.scope_manager.world_vars.items():
-            context[f"world_{name}"] = value
-        for name, value in self.scope_manager.global_vars.items():
-            context[f"global_{name}"] = value
+        # 添加便捷的作用域访问函数（直接引用作用域字典的绑定方法，无需每次创建闭包）
+        scopes = self.scope_manager
+        tail = {
+            'get_conv': scopes.conversation_vars.get,
+            'set_conv': scopes.conversation_vars.__setitem__,
+            'get_preset': scopes.preset_vars.get,
+            'set_preset': scopes.preset_vars.__setitem__,
+            'get_char': scopes.char_vars.get,
+            'set_char': scopes.char_vars.__setitem__,
+            'get_world': scopes.world_vars.get,
+            'set_world': scopes.world_vars.__setitem__,
+            'get_global': scopes.global_vars.get,
+            'set_global': scopes.global_vars.__setitem__,
+        }
+        
+        # 添加legacy函数支持传统宏
+        tail['legacy_roll'] = _legacy_roll
+        tail['legacy_random'] = _legacy_random
+        tail['legacy_pick'] = _legacy_pick
+        tail['legacy_string_op'] = _legacy_string_op
+        tail['legacy_math_op'] = _legacy_math_op
+        
+        # 添加外部注册的原生函数
+        tail.update(self.registered_functions)
+        self._context_tail = tail
+        self._varfn_cache.clear()
+        self._context_proto_version = self._context_version
+        self._context_proto_scopes = self.scope_manager
+    
+    def _make_varfns(self, scope_type: str) -> Tuple[Callable, Callable]:
+        """创建指定作用域类型下的 setvar/getvar 函数"""
+        # 无前缀变量的目标作用域在创建时确定一次
+        scopes = self.scope_manager
+        default_attr = _SCOPE_TYPE_VARS.get(scope_type, 'global_vars')
         
-        # temp_vars 保持直接访问（向后兼容）
-        context.update(self.scope_manager.temp_vars)
-        
-        # 添加便捷的作用域访问函数
-        context['get_conv'] = lambda name: self.scope_manager.conversation_vars.get(name)
-        context['set_conv'] = lambda name, value: self.scope_manager.conversation_vars.update({name: value})
-        context['get_preset'] = lambda name: self.scope_manager.preset_vars.get(name)
-        context['set_preset'] = lambda name, value: self.scope_manager.preset_vars.update({name: value})
-        context['get_char'] = lambda name: self.scope_manager.char_vars.get(name)
-        context['set_char'] = lambda name, value: self.scope_manager.char_vars.update({name: value})
-        context['get_world'] = lambda name: self.scope_manager.world_vars.get(name)
-        context['set_world'] = lambda name, value: self.scope_manager.world_vars.update({name: value})
-        context['get_global'] = lambda name: self.scope_manager.global_vars.get(name)
-        context['set_global'] = lambda name, value: self.scope_manager.global_vars.update({name: value})
-        
-        # 添加传统的setvar/getvar函数（兼容宏处理器）
         def setvar(name: str, value: Any) -> str:
             """根据变量名前缀设置变量到对应作用域"""
-            target_scope_vars = None
-            actual_name = name
-            
-            # 解析变量名前缀
-            if '_' in name:
-                prefix, actual_name = name.split('_', 1)
-                if prefix == 'world':
-                    target_scope_vars = self.scope_manager.world_vars
-                elif prefix == 'preset':
-                    target_scope_vars = self.scope_manager.preset_vars
-                elif prefix == 'char' or prefix == 'character':
-                    target_scope_vars = self.scope_manager.char_vars
-                elif prefix == 'conv' or prefix == 'conversation':
-                    target_scope_vars = self.scope_manager.conversation_vars
-                elif prefix == 'global':
-                    target_scope_vars = self.scope_manager.global_vars
-            
-            # 如果没有前缀或前缀不匹配，使用当前作用域
-            if target_scope_vars is None:
-                actual_name = name  # 恢复完整变量名
-                if scope_type == 'preset':
-                    target_scope_vars = self.scope_manager.preset_vars
-                elif scope_type == 'char' or scope_type == 'character':
-                    target_scope_vars = self.scope_manager.char_vars
-                elif scope_type == 'world':
-                    target_scope_vars = self.scope_manager.world_vars
-                elif scope_type == 'conversation':
-                    target_scope_vars = self.scope_manager.conversation_vars
-                else:
-                    target_scope_vars = self.scope_manager.global_vars
-            
-            target_scope_vars[actual_name] = value
+            scope_attr, actual_name = _split_var_prefix(name, default_attr)
+            getattr(scopes, scope_attr)[actual_name] = value
             return ""  # 返回空字符串，与宏处理器一致
         
         def getvar(name: str, default: Any = "") -> Any:
             """根据变量名前缀从对应作用域获取变量"""
-            target_scope_vars = None
-            actual_name = name
-            
-            # 解析变量名前缀
-            if '_' in name:
-                prefix, actual_name = name.split('_', 1)
-                if prefix == 'world':
-                    target_scope_vars = self.scope_manager.world_vars
-                elif prefix == 'preset':
-                    target_scope_vars = self.scope_manager.preset_vars
-                elif prefix == 'char' or prefix == 'character':
-                    target_scope_vars = self.scope_manager.char_vars
-                elif prefix == 'conv' or prefix == 'conversation':
-                    target_scope_vars = self.scope_manager.conversation_vars
-                elif prefix == 'global':
-                    target_scope_vars = self.scope_manager.global_vars
-            
-            # 如果没有前缀或前缀不匹配，使用当前作用域
-            if target_scope_vars is None:
-                actual_name = name  # 恢复完整变量名
-                if scope_type == 'preset':
-                    target_scope_vars = self.scope_manager.preset_vars
-                elif scope_type == 'char' or scope_type == 'character':
-                    target_scope_vars = self.scope_manager.char_vars
-                elif scope_type == 'world':
-                    target_scope_vars = self.scope_manager.world_vars
-                elif scope_type == 'conversation':
-                    target_scope_vars = self.scope_manager.conversation_vars
-                else:
-                    target_scope_vars = self.scope_manager.global_vars
-            
-            return target_scope_vars.get(actual_name, default)
+            scope_attr, actual_name = _split_var_prefix(name, default_attr)
+            return getattr(scopes, scope_attr).get(actual_name, default)
+        
+        return setvar, getvar
+    
+    def _create_execution_context(self, scope_type: str) -> Dict[str, Any]:
+        """创建统一执行上下文"""
+        # 固定部分只在注册函数或作用域管理器变化后重建
+        if (self._context_proto_version != self._context_version
+                or self._context_proto_scopes is not self.scope_manager):
+            self._build_context_prototype()
+        
+        context = self._context_head.copy()
+        context['current_scope'] = scope_type
+        
+        # 将变量按作用域添加到上下文中，使用前缀区分（变量可能被外部直接修改，每次重新收集）
+        scopes = self.scope_manager
+        for key_format, vars_attr, _ in _CONTEXT_SCOPE_PREFIXES:
+            scope_vars = getattr(scopes, vars_attr)
+            if scope_vars:
+                context.update(zip(map(key_format.format, scope_vars), scope_vars.values()))
+        
+        # temp_vars 保持直接访问（向后兼容）
+        context.update(scopes.temp_vars)
+        
+        # 添加传统的setvar/getvar函数（兼容宏处理器），同一作用域类型复用同一对函数
+        varfns = self._varfn_cache.get(scope_type)
+        if varfns is None:
+            varfns = self._varfn_cache[scope_type] = self._make_varfns(scope_type)
+        setvar, getvar = varfns
         
         # 只有当temp_vars中没有提供时，才使用沙箱内部的版本
         if 'setvar' not in context:
@@ -274,94 +618,52 @@ class PythonSandbox:
         if 'getvar' not in context:
             context['getvar'] = getvar
         
-        # 添加legacy函数支持传统宏
-        def legacy_roll(dice_expr: str) -> str:
-            """处理骰子表达式，如 '1d6' """
-            import random
-            try:
-                if 'd' not in dice_expr.lower():
-                    return "1"
-                
-                parts = dice_expr.lower().split('d')
-                if len(parts) != 2:
-                    return "1"
-                
-                num_dice = int(parts[0].strip()) if parts[0].strip() else 1
-                num_sides = int(parts[1].strip())
-                
-                # 限制范围防止滥用
-                num_dice = min(max(num_dice, 1), 20)
-                num_sides = min(max(num_sides, 2), 100)
-                
-                total = sum(random.randint(1, num_sides) for _ in range(num_dice))
-                return str(total)
-            except (ValueError, AttributeError):
-                return "1"
-        
-        def legacy_random(*choices) -> str:
-            """从选项中随机选择一个"""
-            import random
-            if not choices:
-                return ""
-            return str(random.choice(choices))
-        
-        def legacy_pick(*choices) -> str:
-            """从选项中随机选择一个（与legacy_random相同）"""
-            import random
-            if not choices:
-                return ""
-            return str(random.choice(choices))
-        
-        def legacy_string_op(operation: str, text: str) -> str:
-            """处理字符串操作"""
-            try:
-                if operation == 'upper':
-                    return text.upper()
-                elif operation == 'lower':
-                    return text.lower()
-                elif operation == 'length':
-                    return str(len(text))
-                elif operation == 'reverse':
-                    return text[::-1]
-                else:
-                    return text
-            except:
-                return text
-        
-        context['legacy_roll'] = legacy_roll
-        context['legacy_random'] = legacy_random
-        context['legacy_pick'] = legacy_pick
-        context['legacy_string_op'] = legacy_string_op
+        # 便捷访问函数、legacy函数和外部注册的原生函数
+        context.update(self._context_tail)
         
         # 添加带前缀的函数
-        for name, func in self.scope_manager.conversation_funcs.items():
-            context[f"conv_{name}"] = func
-        for name, func in self.scope_manager.preset_funcs.items():
-            context[f"preset_{name}"] = func
-        for name, func in self.scope_manager.char_funcs.items():
-            context[f"char_{name}"] = func
-        for name, func in self.scope_manager.world_funcs.items():
-            context[f"world_{name}"] = func
-        for name, func in self.scope_manager.global_funcs.items():
-            context[f"global_{name}"] = func
-            
+        for key_format, _, funcs_attr in _CONTEXT_SCOPE_PREFIXES:
+            scope_funcs = getattr(scopes, funcs_attr)
+            if scope_funcs:
+                context.update(zip(map(key_format.format, scope_funcs), scope_funcs.values()))
+        
         return context
     
     @contextmanager
     def _timeout_context(self):
-        """超时控制上下文"""
-        def timeout_handler():
-            raise TimeoutError(f"代码执行超时 ({self.timeout}秒)")
+        """
+        超时控制上下文
+        
+        在主线程上通过 SIGALRM 定时器中断执行中的代码（不再为每次执行创建 Timer 线程）；
+        非主线程或不支持 setitimer 的平台无法安全打断执行，直接放行。
+        """
+        if not _ALARM_SUPPORTED or threading.current_thread() is not threading.main_thread():
+            yield
+            return
+        
+        def timeout_handler(signum, frame):
+            raise _ExecutionTimeout(f"代码执行超时 ({self.timeout}秒)")
         
-        timer = threading.Timer(self.timeout, timeout_handler)
-        timer.start()
+        start = time.monotonic()
+        previous_handler = signal.signal(signal.SIGALRM, timeout_handler)
+        # 嵌套执行时不超过外层剩余的时间
+        outer_delay, outer_interval = signal.setitimer(signal.ITIMER_REAL, self.timeout)
+        if outer_delay and outer_delay < self.timeout:
+            signal.setitimer(signal.ITIMER_REAL, outer_delay)
         try:
             yield
         finally:
-            timer.cancel()
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            # 原处理器不是由Python设置时 signal.signal 返回None，此时恢复为默认处理
+            signal.signal(signal.SIGALRM, previous_handler if previous_handler is not None else signal.SIG_DFL)
+            # 恢复外层定时器的剩余时间
+            if outer_delay:
+                remaining = max(outer_delay - (time.monotonic() - start), 1e-6)
+                signal.setitimer(signal.ITIMER_REAL, remaining, outer_interval)
     
     def execute_code(self, code: str, scope_type: str = 'temp', 
-                    context_vars: Optional[Dict[str, Any]] = None) -> ExecutionResult:
+                    context_vars: Optional[Dict[str, Any]] = None,
+                    expression_only: bool = False) -> ExecutionResult:
         """
         执行Python代码
         
@@ -369,6 +671,7 @@ class PythonSandbox:
             code: 要执行的Python代码
             scope_type: 作用域类型 ('conversation', 'preset', 'character', 'world', 'temp')
             context_vars: 额外的上下文变量
+            expression_only: 只作为单个表达式求值，不回退到语句执行
             
         Returns:
             ExecutionResult: 执行结果
@@ -376,8 +679,8 @@ class PythonSandbox:
         start_time = time.time()
         
         try:
-            # 1. 验证代码安全性
-            self._validate_code(code)
+            # 1. 验证代码安全性并编译（结果按代码缓存）
+            code_obj, is_expression = self._get_compiled(code, expression_only)
             
             # 2. 设置当前作用域（供宏使用）
             self._current_scope = scope_type
@@ -387,69 +690,76 @@ class PythonSandbox:
             if context_vars:
                 context.update(context_vars)
             
-            # 4. 尝试作为表达式求值，如果失败则作为语句执行
+            # 4. 表达式直接求值，语句则执行后读取 result
             result = None
             with self._timeout_context():
-                try:
-                    # 先尝试作为表达式求值
-                    compiled_expr = compile(code, '<sandbox>', 'eval')
-                    result = eval(compiled_expr, context)
-                except SyntaxError:
-                    # 如果不是表达式，则作为语句执行
-                    compiled_code = compile(code, '<sandbox>', 'exec')
-                    exec(compiled_code, context)
+                if is_expression:
+                    # 表达式直接求值
+                    result = eval(code_obj, context)
+                else:
+                    # 不是表达式，则作为语句执行
+                    exec(code_obj, context)
                     # 获取返回值（如果有）
                     if 'result' in context:
                         result = context['result']
             
             execution_time = time.time() - start_time
             
-            return ExecutionResult(
+            return self._make_result(
                 success=True,
                 result=result,
                 execution_time=execution_time
             )
             
-        except TimeoutError as e:
-            return ExecutionResult(
+        except (_ExecutionTimeout, TimeoutError) as e:
+            return self._make_result(
                 success=False,
                 error=str(e),
                 execution_time=time.time() - start_time
             )
         except SecurityError as e:
-            return ExecutionResult(
+            return self._make_result(
                 success=False,
                 error=f"安全错误: {e}",
                 execution_time=time.time() - start_time
             )
         except Exception as e:
-            return ExecutionResult(
+            return self._make_result(
                 success=False,
                 error=f"执行错误: {e}",
                 execution_time=time.time() - start_time
             )
     
+    def _make_result(self, success: bool, result: Any = None, error: Optional[str] = None,
+                     execution_time: float = 0.0) -> ExecutionResult:
+        """创建执行结果，优先复用已归还的对象"""
+        if self._result_pool:
+            return self._result_pool.pop().reset(success, result, error, execution_time)
+        return ExecutionResult(success=success, result=result, error=error, execution_time=execution_time)
+    
+    def release_result(self, result: ExecutionResult) -> None:
+        """
+        归还不再使用的执行结果，供之后的 execute_code 复用
+        
+        归还后调用方不得再读取该对象；不归还的结果照常由垃圾回收处理。
+        """
+        if len(self._result_pool) < _RESULT_POOL_MAX_SIZE:
+            result.result = None  # 不再持有执行结果的引用
+            self._result_pool.append(result)
+    
     def get_scope_variables(self, scope_type: str) -> Dict[str, Any]:
-        """获取指定作用域的变量"""
-        scope_map = {
-            'global': self.scope_manager.global_vars,
-            'conversation': self.scope_manager.conversation_vars,
-            'preset': self.scope_manager.preset_vars,
-            'character': self.scope_manager.char_vars,
-            'world': self.scope_manager.world_vars,
-            'temp': self.scope_manager.temp_vars
-        }
-        return scope_map.get(scope_type, {}).copy()
+        """获取指定作用域的变量（副本）"""
+        scope_attr = _SCOPE_NAME_VARS.get(scope_type)
+        if scope_attr is None:
+            return {}
+        return getattr(self.scope_manager, scope_attr).copy()
     
     def get_all_variables(self) -> Dict[str, Any]:
         """获取所有作用域的变量"""
+        scopes = self.scope_manager
         return {
-            'conversation': self.scope_manager.conversation_vars.copy(),
-            'preset': self.scope_manager.preset_vars.copy(),
-            'character': self.scope_manager.char_vars.copy(),
-            'world': self.scope_manager.world_vars.copy(),
-            'global': self.scope_manager.global_vars.copy(),
-            'temp': self.scope_manager.temp_vars.copy()
+            scope_type: getattr(scopes, scope_attr).copy()
+            for scope_type, scope_attr in _SCOPE_NAME_VARS.items()
         }
     
     def init_conversation_scope(self, chat_history: List[Dict], context: Dict[str, Any]):
@@ -459,27 +769,41 @@ class PythonSandbox:
         self.scope_manager.conversation_funcs.clear()
         
         # 设置基础对话信息
-        self.scope_manager.conversation_vars.update({
-            'chat_history': chat_history,
-            'message_count': len(chat_history),
-            'last_message': chat_history[-1]['content'] if chat_history else '',
-            'last_user_message': self._get_last_message_by_role(chat_history, 'user'),
-            'last_char_message': self._get_last_message_by_role(chat_history, 'assistant'),
-            'conversation_length': sum(len(msg['content']) for msg in chat_history),
-            'user_message_count': len([msg for msg in chat_history if msg['role'] == 'user']),
-            'assistant_message_count': len([msg for msg in chat_history if msg['role'] == 'assistant'])
-        })
+        self.update_conversation_history(chat_history)
         
         # 设置系统上下文
         if context:
             self.scope_manager.conversation_vars['system_context'] = context
     
-    def _get_last_message_by_role(self, chat_history: List[Dict], role: str) -> str:
-        """获取指定角色的最后一条消息"""
-        for msg in reversed(chat_history):
-            if msg.get('role') == role:
-                return msg.get('content', '')
-        return ''
+    def update_conversation_history(self, chat_history: List[Dict]):
+        """根据聊天历史刷新对话作用域中的对话信息（保留用户定义的对话变量）"""
+        # 一次遍历同时统计长度、各角色消息数和各角色最后一条消息
+        conversation_length = 0
+        user_message_count = 0
+        assistant_message_count = 0
+        last_user_message = ''
+        last_char_message = ''
+        for msg in chat_history:
+            content = msg['content']
+            role = msg['role']
+            conversation_length += len(content)
+            if role == 'user':
+                user_message_count += 1
+                last_user_message = content
+            elif role == 'assistant':
+                assistant_message_count += 1
+                last_char_message = content
+        
+        self.scope_manager.conversation_vars.update({
+            'chat_history': chat_history,
+            'message_count': len(chat_history),
+            'last_message': chat_history[-1]['content'] if chat_history else '',
+            'last_user_message': last_user_message,
+            'last_char_message': last_char_message,
+            'conversation_length': conversation_length,
+            'user_message_count': user_message_count,
+            'assistant_message_count': assistant_message_count
+        })
     
     def clear_scope(self, scope_type: str = 'temp'):
         """清除指定作用域"""
@@ -17,22 +17,539 @@
 4. 单遍处理，按injection_order执行
 """
 
+import ast
 import re
-import json
-import random
+import sys
 from datetime import datetime, timedelta
-from typing import Dict, Any, List, Optional, Tuple, Union
+from functools import lru_cache, partial
+from typing import Dict, Any, List, Optional, Set, Tuple, Union
 from dataclasses import dataclass
 
 try:
-    from .python_sandbox import PythonSandbox, create_sandbox
+    from .python_sandbox import (
+        PythonSandbox, create_sandbox, _legacy_math_op, _coerce_number, _format_number,
+        _split_var_prefix, _DATACLASS_SLOTS
+    )
 except ImportError:
     print("⚠️ Python沙盒未找到，将使用降级模式")
     PythonSandbox = None
     create_sandbox = None
+    _legacy_math_op = None
+    _split_var_prefix = None
+    _DATACLASS_SLOTS = {}
+
+
+# 宏匹配模式：{{...}}（不含嵌套花括号）
+# 正则引擎对字面量前缀 `{{` 直接在 str 内部表示上快速查找，
+# 比 str.find 循环或先编码为 bytes 再扫描都快（后者还需额外的编码开销）
+_MACRO_RE = re.compile(r'\{\{([^{}]*)\}\}')
+
+
+class CompiledTemplate:
+    """
+    预解析的宏模板
+
+    解析一次，渲染多次：literals 与 macros 交替排列，
+    literals 比 macros 多一个元素（首尾字面量可能为空字符串）。
+    """
+    __slots__ = ('literals', 'macros')
+
+    def __init__(self, literals: Tuple[str, ...], macros: Tuple[Tuple[str, str], ...]):
+        self.literals = literals
+        self.macros = macros  # (去除首尾空白的宏内容, 原始宏文本)
+
+    def render(self, values: List[str]) -> str:
+        """将各宏的结果（与 macros 一一对应）填回模板"""
+        # 预分配定长列表，字面量与宏结果通过切片赋值一次性交错填入
+        parts = [''] * (len(self.literals) + len(values))
+        parts[0::2] = self.literals
+        parts[1::2] = values
+        return ''.join(parts)
+
+
+@lru_cache(maxsize=1024)
+def compile_template(content: str) -> CompiledTemplate:
+    """将内容解析为 CompiledTemplate（按内容缓存）"""
+    literals = []
+    macros = []
+    last_end = 0
+    for match in _MACRO_RE.finditer(content):
+        literals.append(content[last_end:match.start()])
+        # 宏内容驻留：不同模板中的相同宏共用同一字符串对象，转换缓存查找可直接按身份命中
+        macros.append((sys.intern(match.group(1).strip()), match.group(0)))
+        last_end = match.end()
+    literals.append(content[last_end:])
+    
+    # {{trim}} 去除其两侧紧邻的换行：解析时直接修剪相邻字面量，渲染时无需再处理
+    for index, (macro_content, _) in enumerate(macros):
+        if macro_content == 'trim':
+            literals[index] = literals[index].rstrip('\r\n')
+            literals[index + 1] = literals[index + 1].lstrip('\r\n')
+    return CompiledTemplate(tuple(literals), tuple(macros))
+
+
+# ==================== 传统宏 → Python代码 转换 ====================
+
+# 数学运算宏
+_MATH_OPS = frozenset({'add', 'sub', 'mul', 'div', 'max', 'min'})
+
+# 字符串操作宏
+_STRING_OPS = frozenset({'upper', 'lower', 'length', 'reverse'})
+
+# 数值字面量（可在转换时直接计算）
+_NUM_RE = re.compile(r'^-?\d+(\.\d+)?$')
+
+
+def _convert_roll(params: str) -> str:
+    return f"result = legacy_roll({params!r})"
+
+
+@lru_cache(maxsize=1024)
+def _split_choices(params: str) -> Tuple[str, ...]:
+    """解析 random/pick 的选项：{{random::a::b::c}} 或 {{random:a,b,c}} 格式"""
+    raw_choices = params.split('::')
+    if len(raw_choices) < 2:
+        raw_choices = params.split(',')
+    return tuple(choice.strip() for choice in raw_choices if choice.strip())
+
+
+def _convert_random(params: str) -> str:
+    choices_code = ', '.join(map(repr, _split_choices(params)))
+    return f"result = legacy_random({choices_code})"
+
+
+def _convert_pick(params: str) -> str:
+    choices_code = ', '.join(map(repr, _split_choices(params)))
+    return f"result = legacy_pick({choices_code})"
+
+
+def _convert_math_op(macro_name: str, params: str) -> str:
+    param_list = params.split('::', 2)
+    if len(param_list) < 2:
+        param_list = params.split(':', 2)
+    
+    if len(param_list) >= 2:
+        a, b = param_list[0].strip(), param_list[1].strip()
+        # 两个参数都是数值字面量时，转换时直接计算出结果
+        if _legacy_math_op and _NUM_RE.match(a) and _NUM_RE.match(b):
+            return f"result = {_legacy_math_op(macro_name, a, b)!r}"
+        return f"result = legacy_math_op({macro_name!r}, {a}, {b})"
+    else:
+        return f"result = legacy_math_op({macro_name!r}, {params})"
+
+
+def _convert_string_op(macro_name: str, params: str) -> str:
+    return f"result = legacy_string_op({macro_name!r}, {params!r})"
+
+
+# timeDiff 支持的时间格式
+_TIME_DIFF_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d', '%H:%M:%S')
+
+
+# 补零格式的时间字符串长度固定，按长度即可直接选出对应格式
+_TIME_FORMAT_BY_LENGTH = {
+    19: '%Y-%m-%d %H:%M:%S',
+    10: '%Y-%m-%d',
+    8: '%H:%M:%S',
+}
+
+
+@lru_cache(maxsize=1024)
+def _parse_time_string(time_str: str) -> Optional[datetime]:
+    """
+    解析时间字符串：先只尝试按长度选出的格式，失败时再依次尝试其余格式
+
+    解析结果只取决于字符串本身（仅含时间时日期固定为1900-01-01），
+    datetime 不可变，可按字符串缓存。
+    """
+    guessed = _TIME_FORMAT_BY_LENGTH.get(len(time_str))
+    if guessed is not None:
+        try:
+            return datetime.strptime(time_str, guessed)
+        except ValueError:
+            pass
+    # 未补零等长度不标准的写法，依次尝试其余格式
+    for fmt in _TIME_DIFF_FORMATS:
+        if fmt == guessed:
+            continue
+        try:
+            return datetime.strptime(time_str, fmt)
+        except ValueError:
+            continue
+    return None
+
+
+def _format_time_difference(diff: timedelta) -> str:
+    """格式化时间差为 X天X小时X分钟"""
+    hours, seconds = divmod(diff.seconds, 3600)
+    return f'{diff.days}天{hours}小时{seconds // 60}分钟'
+
+
+def _convert_time_diff(params: str) -> str:
+    time_parts = params.split('::', 2)
+    if len(time_parts) >= 2:
+        # 两个时间都是宏参数中的字面量，转换时直接在宿主侧算出结果
+        time1_dt = _parse_time_string(time_parts[0].strip())
+        time2_dt = _parse_time_string(time_parts[1].strip())
+        if time1_dt and time2_dt:
+            return f"result = {_format_time_difference(time2_dt - time1_dt)!r}"
+    return "result = '时间格式无效'"
+
+
+def _convert_getvar(params: str) -> str:
+    return f"result = getvar({params!r})"
+
+
+def _convert_setvar(params: str) -> str:
+    parts = params.split('::', 1)
+    if len(parts) == 2:
+        var_name, value = parts[0].strip(), parts[1].strip()
+        return f"result = setvar({var_name!r}, {value!r})"
+    return "result = ''"
+
+
+def _convert_addvar(params: str) -> str:
+    parts = params.split('::', 1)
+    if len(parts) == 2:
+        var_name, increment = parts[0].strip(), parts[1].strip()
+        return f"result = addvar({var_name!r}, {increment!r})"
+    return "result = ''"
+
+
+def _convert_incvar(params: str) -> str:
+    return f"result = incvar({params!r})"
+
+
+def _convert_decvar(params: str) -> str:
+    return f"result = decvar({params!r})"
+
+
+# 全局变量读写直接内联为对执行上下文中 global_vars 字典的操作，不经过函数调用
+def _convert_getglobalvar(params: str) -> str:
+    return f"result = global_vars.get({params!r}, '')"
+
+
+def _convert_setglobalvar(params: str) -> str:
+    parts = params.split('::', 1)
+    if len(parts) == 2:
+        var_name, value = parts[0].strip(), parts[1].strip()
+        return f"result = global_vars.update({{{var_name!r}: {value!r}}})"
+    return "result = ''"
+
+
+def _convert_addglobalvar(params: str) -> str:
+    parts = params.split('::', 1)
+    if len(parts) == 2:
+        var_name, value = parts[0].strip(), parts[1].strip()
+        # 增量是数值字面量时，转换时直接解析为数值
+        if _NUM_RE.match(value):
+            return f"result = addglobalvar({var_name!r}, {_coerce_number(value)!r})"
+        return f"result = addglobalvar({var_name!r}, {value!r})"
+    return "result = '参数不足'"
+
+
+def _convert_incglobalvar(params: str) -> str:
+    return f"result = incglobalvar({params!r})"
+
+
+def _convert_decglobalvar(params: str) -> str:
+    return f"result = decglobalvar({params!r})"
+
+
+# SillyTavern（moment.js）风格的日期格式记号的英文名称
+_MONTH_NAMES = ('January', 'February', 'March', 'April', 'May', 'June', 'July',
+                'August', 'September', 'October', 'November', 'December')
+_WEEKDAY_NAMES = ('Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday')
+
+
+_ORDINAL_SUFFIXES = {1: 'st', 2: 'nd', 3: 'rd'}
+
 
+def _ordinal(number: int) -> str:
+    """英文序数词：1st、2nd、3rd、4th、11th、22nd ..."""
+    if 10 <= number % 100 <= 20:
+        return f"{number}th"
+    return f"{number}{_ORDINAL_SUFFIXES.get(number % 10, 'th')}"
 
-@dataclass
+
+def _hour12(dt: datetime) -> int:
+    """12小时制的小时数（0点和12点均为12）"""
+    return dt.hour % 12 or 12
+
+
+# 日期格式记号 → 取值函数（如 YYYY-MM-DD HH:mm:ss、dddd, MMMM Do h A）
+_DATETIME_TOKENS = {
+    'YYYY': lambda dt: f"{dt.year:04d}",
+    'YY': lambda dt: f"{dt.year % 100:02d}",
+    'MMMM': lambda dt: _MONTH_NAMES[dt.month - 1],
+    'MMM': lambda dt: _MONTH_NAMES[dt.month - 1][:3],
+    'MM': lambda dt: f"{dt.month:02d}",
+    'M': lambda dt: str(dt.month),
+    'Do': lambda dt: _ordinal(dt.day),
+    'DD': lambda dt: f"{dt.day:02d}",
+    'D': lambda dt: str(dt.day),
+    'dddd': lambda dt: _WEEKDAY_NAMES[dt.weekday()],
+    'ddd': lambda dt: _WEEKDAY_NAMES[dt.weekday()][:3],
+    'HH': lambda dt: f"{dt.hour:02d}",
+    'H': lambda dt: str(dt.hour),
+    'hh': lambda dt: f"{_hour12(dt):02d}",
+    'h': lambda dt: str(_hour12(dt)),
+    'mm': lambda dt: f"{dt.minute:02d}",
+    'm': lambda dt: str(dt.minute),
+    'ss': lambda dt: f"{dt.second:02d}",
+    's': lambda dt: str(dt.second),
+    'A': lambda dt: 'AM' if dt.hour < 12 else 'PM',
+    'a': lambda dt: 'am' if dt.hour < 12 else 'pm',
+}
+# 连续字母串或 [转义文本]；字母串内按最长记号优先拆分（MMMM 不会被拆成两个 MM）
+_DATETIME_RUN_RE = re.compile(r'\[([^\]]*)\]|[A-Za-z]+')
+_DATETIME_TOKEN_RE = re.compile('|'.join(sorted(_DATETIME_TOKENS, key=len, reverse=True)))
+
+
+@lru_cache(maxsize=256)
+def _compile_datetime_format(fmt: str) -> Tuple[Any, ...]:
+    """
+    将日期格式解析为片段列表（字面量字符串或取值函数）
+    
+    只有能完整拆分为已知记号的字母串才会被转换，其余字母串（如普通单词）原样保留。
+    """
+    parts: List[Any] = []
+    last_end = 0
+    for match in _DATETIME_RUN_RE.finditer(fmt):
+        parts.append(fmt[last_end:match.start()])
+        last_end = match.end()
+        escaped = match.group(1)
+        if escaped is not None:
+            parts.append(escaped)
+            continue
+        run = match.group(0)
+        tokens = _DATETIME_TOKEN_RE.findall(run)
+        if ''.join(tokens) == run:
+            parts.extend(_DATETIME_TOKENS[token] for token in tokens)
+        else:
+            parts.append(run)
+    parts.append(fmt[last_end:])
+    return tuple(part for part in parts if part != '')
+
+
+def _format_datetime(fmt: str, now: datetime) -> str:
+    """按日期格式格式化时间（含 % 时视为 strftime 格式）"""
+    if '%' in fmt:
+        return now.strftime(fmt)
+    return ''.join(part if type(part) is str else part(now) for part in _compile_datetime_format(fmt))
+
+
+def _convert_datetimeformat(params: str, now: datetime) -> str:
+    try:
+        return f"result = {_format_datetime(params, now)!r}"
+    except ValueError:
+        return "result = ''"
+
+
+def _format_time(dt: datetime) -> str:
+    """HH:MM:SS（isoformat 由C直接格式化，比 strftime('%H:%M:%S') 快数倍）"""
+    return dt.time().isoformat('seconds')
+
+
+def _format_date(dt: datetime) -> str:
+    """YYYY-MM-DD（等价于 strftime('%Y-%m-%d')）"""
+    return dt.date().isoformat()
+
+
+# time_UTC 宏的偏移值（如 time_UTC+8、time_UTC-5）
+_UTC_OFFSET_RE = re.compile(r'^time_UTC([+-]?\d+)$')
+
+
+def _convert_time_utc(macro_name: str, now: datetime) -> str:
+    match = _UTC_OFFSET_RE.match(macro_name)
+    if match:
+        # 计算指定时区的时间
+        now = now + timedelta(hours=int(match.group(1)))
+    # 无偏移或偏移值无效时返回当前时间
+    return f"result = {_format_time(now)!r}"
+
+
+def _is_time_dependent_macro(macro_name: str) -> bool:
+    """转换结果依赖当前时间的宏（转换结果不能缓存）"""
+    return macro_name == 'datetimeformat' or macro_name.startswith('time_UTC')
+
+
+# 宏名称 -> 转换函数（参数为宏参数字符串）
+_MACRO_HANDLERS = {
+    # 功能性宏
+    'roll': _convert_roll,
+    'random': _convert_random,
+    'pick': _convert_pick,
+    # 时间差计算
+    'timeDiff': _convert_time_diff,
+    # 变量操作宏（统一作用域感知）
+    'getvar': _convert_getvar,
+    'setvar': _convert_setvar,
+    'addvar': _convert_addvar,
+    'incvar': _convert_incvar,
+    'decvar': _convert_decvar,
+    # 全局变量操作宏
+    'getglobalvar': _convert_getglobalvar,
+    'setglobalvar': _convert_setglobalvar,
+    'addglobalvar': _convert_addglobalvar,
+    'incglobalvar': _convert_incglobalvar,
+    'decglobalvar': _convert_decglobalvar,
+}
+
+# 会写入变量的传统宏
+_VAR_WRITE_MACROS = frozenset({
+    'setvar', 'addvar', 'incvar', 'decvar',
+    'setglobalvar', 'addglobalvar', 'incglobalvar', 'decglobalvar',
+})
+
+# 数学运算宏 / 字符串操作宏按宏名绑定到同一张表
+_MACRO_HANDLERS.update({op: partial(_convert_math_op, op) for op in _MATH_OPS})
+_MACRO_HANDLERS.update({op: partial(_convert_string_op, op) for op in _STRING_OPS})
+
+
+# 直接读取上下文变量的宏（与 _inject_context_variables 注入到 temp_vars 的变量同名）
+_CONTEXT_VAR_MACROS = frozenset({
+    'user', 'char', 'description', 'personality', 'scenario', 'persona',
+    'time', 'date', 'weekday', 'isotime', 'isodate',
+    'input', 'lastMessage', 'lastUserMessage', 'lastCharMessage',
+    'messageCount', 'userMessageCount', 'conversationLength',
+})
+
+# 上下文字段 → 生成其对应上下文变量的处理器方法名（update_context 只刷新变化的字段）
+_CONTEXT_FIELD_BUILDERS = {
+    'character_data': '_character_context_vars',
+    'persona_data': '_persona_context_vars',
+    'current_time': '_time_context_vars',
+    'user_input': '_input_context_vars',
+    'chat_history': '_chat_context_vars',
+}
+
+# 系统变量/特殊宏 → Python代码
+# 上下文变量直接内联为对 temp_vars 的读取，不经过额外的函数调用
+_SYSTEM_MACRO_CODE = {name: f"result = temp_vars.get({name!r}, '')" for name in _CONTEXT_VAR_MACROS}
+_SYSTEM_MACRO_CODE.update({
+    # 特殊宏
+    'newline': "result = '\\n'",
+    'trim': "result = ''",  # 两侧换行在 compile_template 中修剪
+    'noop': "result = ''",
+    'enable': "result = True",
+})
+
+# 中文星期名称（按 datetime.weekday() 顺序）
+_WEEKDAYS = ("星期一", "星期二", "星期三", "星期四", "星期五", "星期六", "星期日")
+
+# 结果固定、无副作用的宏，无需进入沙盒
+_STATIC_MACRO_RESULTS = {
+    'newline': '\n',
+    'trim': '',  # 两侧换行在 compile_template 中修剪
+    'noop': '',
+    'enable': 'True',
+}
+
+_MISSING = object()
+
+# 无前缀变量：当前作用域 → 对应的变量字典属性（其余作用域使用 temp_vars）
+_CURRENT_SCOPE_ATTRS = {
+    'world': 'world_vars',
+    'preset': 'preset_vars',
+    'char': 'char_vars',
+    'conversation': 'conversation_vars',
+}
+
+# 函数调用语法宏中可直接执行的变量函数
+_VAR_FUNCTION_NAMES = ('setvar', 'getvar', 'addvar', 'incvar', 'decvar', 'getglobalvar', 'setglobalvar')
+_VAR_FUNCTION_RE = re.compile('|'.join(_VAR_FUNCTION_NAMES))
+
+
+@lru_cache(maxsize=4096)
+def _split_traditional_macro(macro_content: str) -> Tuple[str, str]:
+    """解析传统宏名称和参数：{{name:params}} 或 {{name::params}}"""
+    macro_name, _, params = macro_content.partition(':')
+    if params.startswith(':'):
+        params = params[1:]
+    return macro_name.strip(), params.strip()
+
+
+@lru_cache(maxsize=4096)
+def _convert_static_macro(macro_name: str, params: str) -> str:
+    """
+    将与时间无关的传统宏转换为Python代码（进程级缓存，所有处理器实例共享）
+
+    Returns:
+        Python代码；无法转换时返回空字符串
+    """
+    # 1. 简单系统变量
+    python_code = _SYSTEM_MACRO_CODE.get(macro_name)
+    if python_code is not None:
+        return python_code
+    
+    # 2. 带参数的宏查表分发
+    handler = _MACRO_HANDLERS.get(macro_name)
+    if handler:
+        return handler(params)
+    
+    # 3. 注释宏
+    if macro_name.startswith('//'):
+        return "result = ''"
+    
+    # 未知宏
+    return ""
+
+
+def _normalize_message(msg: Any) -> Tuple[Optional[str], str]:
+    """将聊天历史中的消息（ChatMessage 或 dict）统一为 (角色, 内容)"""
+    if isinstance(msg, dict):
+        return msg.get('role'), msg.get('content', '')
+    # getattr 带默认值一次取值，代替 hasattr 探测后再取属性
+    role = getattr(msg, 'role', None)
+    if role is not None:
+        role_value = getattr(role, 'value', _MISSING)
+        role = str(role) if role_value is _MISSING else role_value
+    content = getattr(msg, 'content', _MISSING)
+    return role, str(msg) if content is _MISSING else content
+
+
+def _needs_macro_processing(message: Dict[str, Any]) -> bool:
+    """消息是否需要逐步处理（动态enabled、代码块或内容中含宏）"""
+    if message.get('enabled', True) is not True or message.get('code_block'):
+        return True
+    content = message.get('content')
+    return isinstance(content, str) and '{{' in content
+
+
+def _single_expression(python_code: str) -> Optional[str]:
+    """提取单行 `result = <表达式>` 形式代码中的表达式，其他形式返回None"""
+    if python_code.startswith('result = ') and '\n' not in python_code:
+        return python_code[len('result = '):]
+    return None
+
+
+@lru_cache(maxsize=1024)
+def _is_single_line_expression(python_code: str) -> bool:
+    """代码是否为单行Python表达式（可拼接进批量执行的代码）"""
+    if '\n' in python_code or '\r' in python_code or '#' in python_code:
+        return False
+    try:
+        ast.parse(python_code, mode='eval')
+    except SyntaxError:
+        return False
+    return True
+
+
+def _is_function_call_macro(macro_content: str) -> bool:
+    """是否是函数调用语法的宏（如 setvar('status', 'active')）"""
+    return ('(' in macro_content and ')' in macro_content
+            and _VAR_FUNCTION_RE.search(macro_content) is not None)
+
+
+def _reads_context_var(macro_content: str) -> bool:
+    """宏是否在宿主侧直接读取上下文变量（如 {{char}}、{{python:char}}）"""
+    if macro_content.startswith('python:'):
+        macro_content = macro_content[7:]
+    return macro_content in _CONTEXT_VAR_MACROS
+
+
+@dataclass(**_DATACLASS_SLOTS)
 class MacroExecutionContext:
     """宏执行上下文"""
     current_scope: str = 'temp'  # 当前执行作用域
@@ -64,190 +581,189 @@ class UnifiedMacroProcessor:
     4. 单遍处理：按顺序逐个处理，确保依赖关系正确
     """
     
-    def __init__(self, context: MacroExecutionContext = None):
+    def __init__(self, context: MacroExecutionContext = None, sandbox: Optional[PythonSandbox] = None):
         self.context = context or MacroExecutionContext()
         self.sandbox = None
-        self._init_sandbox()
+        self._init_sandbox(sandbox)
         
-        # 传统宏转换规则
-        self._init_traditional_macro_converters()
+        # 传统宏转换结果缓存：宏内容 -> Python代码
+        self._conversion_cache: Dict[str, str] = {}
+        
+        # 本次渲染的时间快照，同一次处理中的时间宏结果保持一致
+        self._render_now: Optional[datetime] = None
+        
+        # 时间相关宏的转换结果缓存（结果精确到秒，同一秒内可直接复用）
+        self._time_macro_cache: Dict[str, str] = {}
+        self._time_macro_second: Optional[datetime] = None
+        
+        # 当前作用域（供无前缀的 unified_getvar/unified_setvar 使用）
+        self._current_scope = 'temp'
     
-    def _init_sandbox(self):
-        """初始化Python沙盒"""
+    def _init_sandbox(self, sandbox: Optional[PythonSandbox] = None):
+        """初始化Python沙盒（传入共享沙盒时直接复用，不再新建）"""
         if not PythonSandbox:
             print("⚠️ Python沙盒不可用，宏功能受限")
             return
             
         try:
-            self.sandbox = create_sandbox()
+            self.sandbox = sandbox if sandbox is not None else create_sandbox()
             self._inject_unified_functions()
             self._inject_context_variables()
         except Exception as e:
             print(f"⚠️ 沙盒初始化失败: {e}")
             self.sandbox = None
     
-    def _init_traditional_macro_converters(self):
-        """初始化传统宏转换规则"""
-        self.macro_converters = {
-            # 系统变量 - 直接访问
-            'user': "result = user",
-            'char': "result = char", 
-            'description': "result = description",
-            'personality': "result = personality",
-            'scenario': "result = scenario",
-            'persona': "result = persona",
-            
-            # 时间变量
-            'time': "result = time",
-            'date': "result = date",
-            'weekday': "result = weekday",
-            'isotime': "result = isotime",
-            'isodate': "result = isodate",
-            
-            # 消息变量
-            'input': "result = input",
-            'lastMessage': "result = lastMessage",
-            'lastUserMessage': "result = lastUserMessage", 
-            'lastCharMessage': "result = lastCharMessage",
-            'messageCount': "result = messageCount",
-            'userMessageCount': "result = userMessageCount",
-            'conversationLength': "result = conversationLength",
-            
-            # 特殊宏
-            'newline': "result = '\\n'",
-            'trim': "result = ''",  # trim宏的特殊处理在外层
-            'noop': "result = ''",
-            'enable': "result = True",
-        }
-    
     def _inject_unified_functions(self):
         """注入统一的宏函数到沙盒"""
         if not self.sandbox:
             return
-            
-        # 注入传统宏兼容函数（简化版本，避免import问题）
-        compatibility_code = '''
-# 作用域感知的变量操作函数
-def unified_getvar(name, default=""):
-    """统一的作用域感知变量获取"""
-    # 检查前缀，确定目标作用域
-    if name.startswith('world_'):
-        var_name = name[6:]  # 移除 'world_' 前缀
-        return world_vars.get(var_name, default)
-    elif name.startswith('preset_'):
-        var_name = name[7:]  # 移除 'preset_' 前缀
-        return preset_vars.get(var_name, default)
-    elif name.startswith('char_') or name.startswith('character_'):
-        prefix_len = 5 if name.startswith('char_') else 10
-        var_name = name[prefix_len:]
-        return char_vars.get(var_name, default)
-    elif name.startswith('conv_') or name.startswith('conversation_'):
-        prefix_len = 5 if name.startswith('conv_') else 13
-        var_name = name[prefix_len:]
-        return conversation_vars.get(var_name, default)
-    elif name.startswith('global_'):
-        var_name = name[7:]  # 移除 'global_' 前缀
-        return global_vars.get(var_name, default)
-    else:
-        # 无前缀，使用当前作用域
-        current_scope = globals().get('_current_scope', 'temp')
-        if current_scope == 'world':
-            return world_vars.get(name, default)
-        elif current_scope == 'preset':
-            return preset_vars.get(name, default)
-        elif current_scope == 'char':
-            return char_vars.get(name, default)
-        elif current_scope == 'conversation':
-            return conversation_vars.get(name, default)
-        else:
-            return temp_vars.get(name, default)
-
-def unified_setvar(name, value):
-    """统一的作用域感知变量设置"""
-    # 检查前缀，确定目标作用域
-    if name.startswith('world_'):
-        var_name = name[6:]
-        world_vars[var_name] = value
-    elif name.startswith('preset_'):
-        var_name = name[7:]
-        preset_vars[var_name] = value
-    elif name.startswith('char_') or name.startswith('character_'):
-        prefix_len = 5 if name.startswith('char_') else 10
-        var_name = name[prefix_len:]
-        char_vars[var_name] = value
-    elif name.startswith('conv_') or name.startswith('conversation_'):
-        prefix_len = 5 if name.startswith('conv_') else 13
-        var_name = name[prefix_len:]
-        conversation_vars[var_name] = value
-    elif name.startswith('global_'):
-        var_name = name[7:]
-        global_vars[var_name] = value
-    else:
-        # 无前缀，使用当前作用域
-        current_scope = globals().get('_current_scope', 'temp')
-        if current_scope == 'world':
-            world_vars[name] = value
-        elif current_scope == 'preset':
-            preset_vars[name] = value
-        elif current_scope == 'char':
-            char_vars[name] = value
-        elif current_scope == 'conversation':
-            conversation_vars[name] = value
-        else:
-            temp_vars[name] = value
-    return ""
-
-# 将函数注册到全局命名空间
-getvar = unified_getvar
-setvar = unified_setvar
-
-# 向后兼容的全局变量操作
-getglobalvar = lambda name, default="": global_vars.get(name, default)
-setglobalvar = lambda name, value: global_vars.update({name: value}) or ""
-'''
         
-        result = self.sandbox.execute_code(compatibility_code, scope_type='global')
-        if not result.success:
-            print(f"⚠️ 统一函数注入失败: {result.error}")
+        # 以原生函数注册，避免每次创建处理器都编译执行兼容代码
+        self.sandbox.register_functions({
+            'unified_getvar': self._unified_getvar,
+            'unified_setvar': self._unified_setvar,
+            # 向后兼容的全局变量操作
+            'getglobalvar': self._getglobalvar,
+            'setglobalvar': self._setglobalvar,
+            'addglobalvar': self._addglobalvar,
+            'incglobalvar': self._incglobalvar,
+            'decglobalvar': self._decglobalvar,
+        })
+    
+    def _resolve_scope_vars(self, name: str) -> Tuple[Dict[str, Any], str]:
+        """根据变量名前缀确定目标作用域，返回（作用域变量字典, 实际变量名）"""
+        scope_manager = self.sandbox.scope_manager
+        
+        # 检查前缀，确定目标作用域；无前缀时使用当前作用域（同一变量名只解析一次）
+        scope_attr, var_name = _split_var_prefix(
+            name, _CURRENT_SCOPE_ATTRS.get(self._current_scope, 'temp_vars')
+        )
+        return getattr(scope_manager, scope_attr), var_name
+    
+    def _unified_getvar(self, name: str, default: Any = "") -> Any:
+        """统一的作用域感知变量获取"""
+        scope_vars, var_name = self._resolve_scope_vars(name)
+        return scope_vars.get(var_name, default)
+    
+    def _unified_setvar(self, name: str, value: Any) -> str:
+        """统一的作用域感知变量设置"""
+        scope_vars, var_name = self._resolve_scope_vars(name)
+        scope_vars[var_name] = value
+        return ""
+    
+    def _getglobalvar(self, name: str, default: Any = "") -> Any:
+        return self.sandbox.scope_manager.global_vars.get(name, default)
+    
+    def _setglobalvar(self, name: str, value: Any) -> str:
+        self.sandbox.scope_manager.global_vars[name] = value
+        return ""
     
-    def _inject_context_variables(self):
-        """注入上下文变量到沙盒"""
+    def _addglobalvar(self, name: str, value: Any) -> str:
+        """全局变量加上指定值（非数值时拼接字符串）"""
+        global_vars = self.sandbox.scope_manager.global_vars
+        current = global_vars.get(name, '0')
+        try:
+            result = _format_number(_coerce_number(current) + _coerce_number(value))
+        except (ValueError, TypeError):
+            result = f"{current}{value}"  # 非数字则拼接字符串
+        global_vars[name] = result
+        return result
+    
+    def _incglobalvar(self, name: str) -> str:
+        return self._step_global_number(name, 1)
+    
+    def _decglobalvar(self, name: str) -> str:
+        return self._step_global_number(name, -1)
+    
+    def _step_global_number(self, name: str, step: int) -> str:
+        """全局变量加减1（无法转换为数字时重置为步长）"""
+        global_vars = self.sandbox.scope_manager.global_vars
+        try:
+            result = _format_number(_coerce_number(global_vars.get(name, '0')) + step)
+        except (ValueError, TypeError):
+            result = str(step)
+        global_vars[name] = result
+        return result
+    
+    def _inject_context_variables(self, fields: Optional[Set[str]] = None):
+        """
+        注入上下文变量到沙盒
+        
+        Args:
+            fields: 发生变化的上下文字段名；为None时注入全部上下文变量
+        """
         if not self.sandbox:
             return
         
-        # 构建上下文变量
-        context_vars = {
-            # 角色信息
-            'char': self.context.character_data.get('name', ''),
-            'description': self.context.character_data.get('description', ''),
-            'personality': self.context.character_data.get('personality', ''),
-            'scenario': self.context.character_data.get('scenario', ''),
+        temp_vars = self.sandbox.scope_manager.temp_vars
+        if fields is None:
+            fields = _CONTEXT_FIELD_BUILDERS.keys()
+            temp_vars['enable'] = True  # 保留变量
+        
+        # 只重新计算受影响的上下文变量，注入到临时作用域
+        for field_name in fields:
+            builder = _CONTEXT_FIELD_BUILDERS.get(field_name)
+            if builder is not None:
+                temp_vars.update(getattr(self, builder)())
+    
+    def _character_context_vars(self) -> Dict[str, Any]:
+        """角色信息"""
+        character_data = self.context.character_data
+        return {
+            'char': character_data.get('name', ''),
+            'description': character_data.get('description', ''),
+            'personality': character_data.get('personality', ''),
+            'scenario': character_data.get('scenario', ''),
+        }
+    
+    def _persona_context_vars(self) -> Dict[str, Any]:
+        """玩家角色信息"""
+        return {
             'user': self.context.persona_data.get('name', 'User'),
             'persona': self._get_persona_description(),
-            
-            # 时间相关
-            'time': self.context.current_time.strftime('%H:%M:%S'),
-            'date': self.context.current_time.strftime('%Y-%m-%d'),
+        }
+    
+    def _time_context_vars(self) -> Dict[str, Any]:
+        """时间相关"""
+        current_time = self.context.current_time
+        time_str = _format_time(current_time)
+        date_str = _format_date(current_time)
+        return {
+            'time': time_str,
+            'date': date_str,
             'weekday': self._get_weekday_chinese(),
-            'isotime': self.context.current_time.strftime('%H:%M:%S'),
-            'isodate': self.context.current_time.strftime('%Y-%m-%d'),
-            
-            # 聊天信息
-            'input': self.context.user_input,
-            'lastMessage': self._get_last_message(),
-            'lastUserMessage': self._get_last_user_message(),
-            'lastCharMessage': self._get_last_char_message(),
+            'isotime': time_str,
+            'isodate': date_str,
+        }
+    
+    def _input_context_vars(self) -> Dict[str, Any]:
+        """用户输入"""
+        return {'input': self.context.user_input}
+    
+    def _chat_context_vars(self) -> Dict[str, Any]:
+        """聊天信息（一次遍历聊天历史，同时得到各统计项和各角色的最后一条消息）"""
+        last_message = ""
+        last_user_message = None
+        last_char_message = None
+        user_message_count = 0
+        conversation_length = 0
+        for msg in self.context.chat_history:
+            role, content = _normalize_message(msg)
+            last_message = content
+            conversation_length += len(content)
+            if role == 'user':
+                user_message_count += 1
+                last_user_message = content
+            elif role == 'assistant':
+                last_char_message = content
+        return {
+            'lastMessage': last_message,
+            'lastUserMessage': last_user_message or "",
+            'lastCharMessage': last_char_message or "",
             'messageCount': str(len(self.context.chat_history)),
-            'userMessageCount': str(self._count_user_messages()),
-            'conversationLength': str(self._get_conversation_length()),
-            
-            # 保留变量
-            'enable': True,
+            'userMessageCount': str(user_message_count),
+            'conversationLength': str(conversation_length),
         }
-        
-        # 注入到临时作用域
-        for name, value in context_vars.items():
-            self.sandbox.scope_manager.temp_vars[name] = value
     
     def _get_persona_description(self) -> str:
         """获取玩家角色描述"""
@@ -264,65 +780,7 @@ setglobalvar = lambda name, value: global_vars.update({name: value}) or ""
     
     def _get_weekday_chinese(self) -> str:
         """获取中文星期"""
-        weekdays = ["星期一", "星期二", "星期三", "星期四", "星期五", "星期六", "星期日"]
-        return weekdays[self.context.current_time.weekday()]
-    
-    def _get_last_message(self) -> str:
-        """获取最后一条消息"""
-        if not self.context.chat_history:
-            return ""
-        last_msg = self.context.chat_history[-1]
-        if hasattr(last_msg, 'content'):
-            return last_msg.content
-        elif isinstance(last_msg, dict):
-            return last_msg.get('content', '')
-        return str(last_msg)
-    
-    def _get_last_user_message(self) -> str:
-        """获取最后一条用户消息"""
-        for msg in reversed(self.context.chat_history):
-            if hasattr(msg, 'role'):
-                role = msg.role.value if hasattr(msg.role, 'value') else str(msg.role)
-                if role == 'user':
-                    return msg.content
-            elif isinstance(msg, dict) and msg.get('role') == 'user':
-                return msg.get('content', '')
-        return ""
-    
-    def _get_last_char_message(self) -> str:
-        """获取最后一条角色消息"""
-        for msg in reversed(self.context.chat_history):
-            if hasattr(msg, 'role'):
-                role = msg.role.value if hasattr(msg.role, 'value') else str(msg.role)
-                if role == 'assistant':
-                    return msg.content
-            elif isinstance(msg, dict) and msg.get('role') == 'assistant':
-                return msg.get('content', '')
-        return ""
-    
-    def _count_user_messages(self) -> int:
-        """统计用户消息数量"""
-        count = 0
-        for msg in self.context.chat_history:
-            if hasattr(msg, 'role'):
-                role = msg.role.value if hasattr(msg.role, 'value') else str(msg.role)
-                if role == 'user':
-                    count += 1
-            elif isinstance(msg, dict) and msg.get('role') == 'user':
-                count += 1
-        return count
-    
-    def _get_conversation_length(self) -> int:
-        """计算对话总长度"""
-        length = 0
-        for msg in self.context.chat_history:
-            if hasattr(msg, 'content'):
-                length += len(msg.content)
-            elif isinstance(msg, dict):
-                length += len(msg.get('content', ''))
-            else:
-                length += len(str(msg))
-        return length
+        return _WEEKDAYS[self.context.current_time.weekday()]
     
     def process_content(self, content: str, scope_type: str = 'temp') -> str:
         """
@@ -341,9 +799,15 @@ setglobalvar = lambda name, value: global_vars.update({name: value}) or ""
         if not self.sandbox:
             return content  # 沙盒不可用时返回原内容
         
+        # 含 "{{" 但没有完整宏时（解析结果按内容缓存），无需设置作用域和时间快照
+        template = compile_template(content)
+        if not template.macros:
+            return content
+        
         # 设置当前作用域
-        self.sandbox.execute_code(f"globals()['_current_scope'] = '{scope_type}'", scope_type='global')
+        self._current_scope = scope_type
         
+        self._render_now = datetime.now()
         try:
             return self._process_all_macros(content, scope_type)
         except Exception as e:
@@ -352,32 +816,165 @@ setglobalvar = lambda name, value: global_vars.update({name: value}) or ""
     
     def _process_all_macros(self, content: str, scope_type: str) -> str:
         """处理所有宏：统一转换和执行"""
-        result_content = content
+        template = compile_template(content)
+        if not template.macros:
+            return content
         
-        # 查找所有宏
-        macro_pattern = r'\{\{([^{}]*)\}\}'
-        macros_found = re.findall(macro_pattern, result_content)
+        # 从左到右执行，保证宏按出现顺序执行
+        results = self._execute_macros(template.macros, scope_type)
+        return self._clean_macro_artifacts(template.render(results))
+    
+    def _execute_macros(self, macros: Tuple[Tuple[str, str], ...], scope_type: str) -> List[str]:
+        """
+        按顺序执行一组宏，返回各宏的替换结果
         
-        if not macros_found:
-            return result_content
+        连续的单表达式传统宏会合并为一次沙盒调用执行，
+        Python宏等其他宏会先提交之前累积的批次，再单独执行。
+        """
+        results: List[str] = [""] * len(macros)
+        batch: List[Tuple[int, str, str, str]] = []  # (序号, 宏内容, 原始宏文本, 表达式)
+        batch_may_write = False  # 批次中是否有可能写入变量的宏
+        # 同一内容中重复出现的宿主侧宏（如多个 {{char}}）只求值一次；单独执行沙盒代码后失效
+        host_results: Dict[str, str] = {}
         
-        # 逐个处理宏
-        for macro_content in macros_found:
-            full_macro = f"{{{{{macro_content}}}}}"
+        for index, (macro_content, full_macro) in enumerate(macros):
+            # 宿主侧读取的是上下文变量的当前值（含缓存的结果），
+            # 批次中已有可能写入变量的宏时先提交批次，保证读到写入后的值
+            if batch_may_write and _reads_context_var(macro_content):
+                self._flush_macro_batch(batch, results, scope_type)
+                batch.clear()
+                host_results.clear()
+                batch_may_write = False
             
-            try:
-                # 转换并执行宏
-                replacement = self._execute_single_macro(macro_content.strip(), scope_type)
-                
-                # 替换宏为结果（只替换第一个匹配，避免重复替换）
-                result_content = result_content.replace(full_macro, str(replacement), 1)
-                
-            except Exception as e:
-                print(f"⚠️ 宏 '{full_macro}' 处理失败: {e}")
-                # 失败时保持原样
-                pass
+            host_result = host_results.get(macro_content)
+            if host_result is None:
+                host_result = self._resolve_on_host(macro_content)
+                if host_result is not None:
+                    host_results[macro_content] = host_result
+            if host_result is not None:
+                results[index] = host_result
+                continue
+            
+            # 之前的宏都已执行完毕时，变量读取宏可直接在宿主侧求值
+            if not batch:
+                var_result = self._resolve_variable_on_host(macro_content, scope_type)
+                if var_result is not None:
+                    results[index] = var_result
+                    continue
+            
+            expression = self._get_batchable_expression(macro_content)
+            if expression is not None:
+                is_python = macro_content.startswith('python:')
+                # Python表达式直接读取执行上下文中的变量快照（如 global_x、conv_x），
+                # 批次中已有可能写入变量的宏时先提交批次，保证读到之前的宏写入后的值
+                if is_python and batch_may_write:
+                    self._flush_macro_batch(batch, results, scope_type)
+                    batch.clear()
+                    host_results.clear()
+                    batch_may_write = False
+                batch.append((index, macro_content, full_macro, expression))
+                # Python表达式可以调用任意函数，按可能写入变量处理
+                batch_may_write = (batch_may_write or is_python
+                                   or _split_traditional_macro(macro_content)[0] in _VAR_WRITE_MACROS)
+                continue
+            
+            self._flush_macro_batch(batch, results, scope_type)
+            batch.clear()  # 复用同一个批次列表
+            batch_may_write = False
+            host_results.clear()
+            results[index] = self._resolve_macro(macro_content, full_macro, scope_type)
+        
+        self._flush_macro_batch(batch, results, scope_type)
+        return results
+    
+    def _flush_macro_batch(self, batch: List[Tuple[int, str, str, str]], results: List[str], scope_type: str) -> None:
+        """将累积的单表达式宏合并为一段代码，在沙盒中一次执行"""
+        if not batch:
+            return
+        
+        collected: List[Any] = []
+        if len(batch) > 1:
+            code = '\n'.join(f"_macro_results.append(({expression}))" for _, _, _, expression in batch)
+            self._run_in_sandbox(code, scope_type, context_vars={'_macro_results': collected})
+        
+        # collected 记录了出错前已成功执行的宏，其余宏逐个执行以保留原有的错误处理
+        for position, (index, macro_content, full_macro, _) in enumerate(batch):
+            if position < len(collected):
+                value = collected[position]
+                results[index] = str(value) if value is not None else ""
+            else:
+                results[index] = self._resolve_macro(macro_content, full_macro, scope_type)
+    
+    def _resolve_macro(self, macro_content: str, full_macro: str, scope_type: str) -> str:
+        """执行单个宏，失败时保持原样"""
+        try:
+            # 转换并执行宏
+            return str(self._execute_single_macro(macro_content, scope_type))
+        except Exception as e:
+            print(f"⚠️ 宏 '{full_macro}' 处理失败: {e}")
+            # 失败时保持原样
+            return full_macro
+    
+    def _resolve_on_host(self, macro_content: str) -> Optional[str]:
+        """
+        在宿主侧直接求值纯读取/常量宏，跳过沙盒
+        
+        Returns:
+            宏结果；需要进入沙盒执行时返回None
+        """
+        if not macro_content:
+            return ""
+        static_result = _STATIC_MACRO_RESULTS.get(macro_content)
+        if static_result is not None:
+            return static_result
+        if macro_content.startswith('//'):
+            return ""
+        if macro_content.startswith('python:'):
+            # 只引用上下文变量的Python宏（如 {{python:char}}）与 {{char}} 等价
+            macro_content = macro_content[7:]
+        if macro_content in _CONTEXT_VAR_MACROS and self.sandbox:
+            value = self.sandbox.scope_manager.temp_vars.get(macro_content, _MISSING)
+            if value is not _MISSING:
+                return str(value) if value is not None else ""
+        return None
+    
+    def _resolve_variable_on_host(self, macro_content: str, scope_type: str) -> Optional[str]:
+        """
+        在宿主侧直接求值 {{getvar::name}} / {{getglobalvar::name}}，与沙盒内执行结果一致
         
-        return self._clean_macro_artifacts(result_content)
+        Returns:
+            宏结果；不是变量读取宏时返回None
+        """
+        macro_name, params = _split_traditional_macro(macro_content)
+        if macro_name == 'getvar':
+            scope_vars, var_name = self.sandbox.resolve_variable_scope(params, scope_type)
+            value = scope_vars.get(var_name, '')
+        elif macro_name == 'getglobalvar':
+            value = self.sandbox.scope_manager.global_vars.get(params, '')
+        else:
+            return None
+        return str(value) if value is not None else ""
+    
+    def _get_batchable_expression(self, macro_content: str) -> Optional[str]:
+        """获取可合并执行的传统宏表达式（仅限单行 `result = <表达式>` 形式）"""
+        if macro_content.startswith('python:'):
+            # 单行表达式形式的Python宏同样可以合并执行
+            python_code = macro_content[7:]
+            return python_code if _is_single_line_expression(python_code) else None
+        if _is_function_call_macro(macro_content):
+            return None
+        return _single_expression(self._get_traditional_macro_code(macro_content))
+    
+    def _run_in_sandbox(self, code: str, scope_type: str, **kwargs: Any) -> Tuple[bool, Any, Optional[str]]:
+        """
+        在沙盒中执行代码，返回 (是否成功, 结果, 错误信息)
+        
+        处理器内部所有沙盒调用都经过这里：取出所需字段后立即归还 ExecutionResult 供沙盒复用。
+        """
+        result = self.sandbox.execute_code(code, scope_type=scope_type, **kwargs)
+        outcome = (result.success, result.result, result.error)
+        self.sandbox.release_result(result)
+        return outcome
     
     def _execute_single_macro(self, macro_content: str, scope_type: str) -> str:
         """执行单个宏"""
@@ -387,8 +984,8 @@ setglobalvar = lambda name, value: global_vars.update({name: value}) or ""
         # 1. 处理Python宏
         if macro_content.startswith('python:'):
             python_code = macro_content[7:]  # 移除 'python:' 前缀
-            result = self.sandbox.execute_code(python_code, scope_type=scope_type)
-            return str(result.result) if result.success and result.result is not None else ""
+            success, value, _ = self._run_in_sandbox(python_code, scope_type)
+            return str(value) if success and value is not None else ""
         
         # 2. 处理传统宏
         return self._execute_traditional_macro(macro_content, scope_type)
@@ -396,258 +993,86 @@ setglobalvar = lambda name, value: global_vars.update({name: value}) or ""
     def _execute_traditional_macro(self, macro_content: str, scope_type: str) -> str:
         """执行传统宏（转换为Python代码）"""
         
+        # 纯读取/常量宏直接在宿主侧求值，跳过沙盒
+        host_result = self._resolve_on_host(macro_content)
+        if host_result is not None:
+            return host_result
+        
         # 🔧 修复：检查是否是函数调用语法（如 setvar('status', 'active')）
-        if '(' in macro_content and ')' in macro_content:
-            # 尝试直接作为Python表达式执行
-            if any(func_name in macro_content for func_name in ['setvar', 'getvar', 'addvar', 'incvar', 'decvar', 'getglobalvar', 'setglobalvar']):
-                # 为函数调用添加 result = 前缀
-                python_code = f"result = {macro_content.strip()}"
-                result = self.sandbox.execute_code(python_code, scope_type=scope_type)
-                if result.success:
-                    return str(result.result) if result.result is not None else ""
-                else:
-                    print(f"⚠️ 函数调用宏执行失败: {result.error}")
-                    # 如果函数调用失败，尝试传统转换方式
-        
-        # 解析传统宏名称和参数
-        if ':' in macro_content:
-            parts = macro_content.split(':', 1)
-            macro_name = parts[0].strip()
-            params = parts[1].strip()
-        else:
-            macro_name = macro_content.strip()
-            params = ""
+        if _is_function_call_macro(macro_content):
+            # 为函数调用添加 result = 前缀
+            python_code = f"result = {macro_content.strip()}"
+            success, value, error = self._run_in_sandbox(python_code, scope_type)
+            if success:
+                return str(value) if value is not None else ""
+            else:
+                print(f"⚠️ 函数调用宏执行失败: {error}")
+                # 如果函数调用失败，尝试传统转换方式
         
-        # 转换为Python代码
-        python_code = self._convert_traditional_macro_to_python(macro_name, params)
+        python_code = self._get_traditional_macro_code(macro_content)
         
         if python_code:
-            # 执行转换后的Python代码
-            result = self.sandbox.execute_code(python_code, scope_type=scope_type)
-            if result.success:
-                return str(result.result) if result.result is not None else ""
+            # 执行转换后的Python代码（单表达式直接求值，不经过语句执行）
+            expression = _single_expression(python_code)
+            if expression is not None:
+                success, value, error = self._run_in_sandbox(expression, scope_type, expression_only=True)
+            else:
+                success, value, error = self._run_in_sandbox(python_code, scope_type)
+            if success:
+                return str(value) if value is not None else ""
             else:
-                print(f"⚠️ 传统宏执行失败: {result.error}")
+                print(f"⚠️ 传统宏执行失败: {error}")
                 return ""
         else:
             # 无法转换的宏，保持原样
             return f"{{{{{macro_content}}}}}"
     
-    def _convert_traditional_macro_to_python(self, macro_name: str, params: str) -> str:
-        """将传统宏转换为Python代码"""
-        
-        # 1. 简单系统变量
-        if macro_name in self.macro_converters:
-            return self.macro_converters[macro_name]
-        
-        # 2. 注释宏
-        if macro_name.startswith('//'):
-            return "result = ''"
-        
-        # 3. 功能性宏
-        if macro_name == 'roll':
-            return f"result = legacy_roll('{params}')"
-        
-        elif macro_name == 'random':
-            if '::' in params:
-                # {{random::a::b::c}} 格式
-                choices = [f"'{choice.strip()}'" for choice in params.split('::') if choice.strip()]
-            else:
-                # {{random:a,b,c}} 格式
-                choices = [f"'{choice.strip()}'" for choice in params.split(',') if choice.strip()]
-            choices_code = ', '.join(choices)
-            return f"result = legacy_random({choices_code})"
-        
-        elif macro_name == 'pick':
-            if '::' in params:
-                choices = [f"'{choice.strip()}'" for choice in params.split('::') if choice.strip()]
-            else:
-                choices = [f"'{choice.strip()}'" for choice in params.split(',') if choice.strip()]
-            choices_code = ', '.join(choices)
-            return f"result = legacy_pick({choices_code})"
-        
-        # 4. 数学运算宏
-        elif macro_name in ['add', 'sub', 'mul', 'div', 'max', 'min']:
-            if '::' in params:
-                param_list = params.split('::')
-            elif ':' in params:
-                param_list = params.split(':')
-            else:
-                param_list = [params]
-            
-            if len(param_list) >= 2:
-                a, b = param_list[0].strip(), param_list[1].strip()
-                return f"result = legacy_math_op('{macro_name}', {a}, {b})"
-            else:
-                return f"result = legacy_math_op('{macro_name}', {params})"
-        
-        # 5. 字符串操作宏
-        elif macro_name in ['upper', 'lower', 'length', 'reverse']:
-            return f"result = legacy_string_op('{macro_name}', '{params}')"
-        
-        # 时间差计算
-        elif macro_name == 'timeDiff':
-            if '::' in params:
-                time_parts = params.split('::')
-                if len(time_parts) >= 2:
-                    time1, time2 = time_parts[0], time_parts[1]
-                    # 注意：这里使用 strptime 解析时间字符串，可能需要特定格式
-                    return f"""
-try:
-    from datetime import datetime
-    formats = ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d', '%H:%M:%S']
-    time1_dt = None
-    time2_dt = None
-    
-    # 尝试多种格式解析时间
-    for fmt in formats:
-        try:
-            time1_dt = datetime.strptime('{time1}', fmt)
-            break
-        except ValueError:
-            continue
-    
-    for fmt in formats:
-        try:
-            time2_dt = datetime.strptime('{time2}', fmt)
-            break
-        except ValueError:
-            continue
+    def _get_traditional_macro_code(self, macro_content: str) -> str:
+        """将传统宏转换为Python代码（同一宏文本只转换一次）"""
+        python_code = self._conversion_cache.get(macro_content)
+        if python_code is None:
+            macro_name, params = _split_traditional_macro(macro_content)
+            if _is_time_dependent_macro(macro_name):
+                return self._get_time_macro_code(macro_content, macro_name, params)
+            python_code = _convert_static_macro(macro_name, params)
+            self._conversion_cache[macro_content] = python_code
+        return python_code
     
-    if time1_dt and time2_dt:
-        diff = time2_dt - time1_dt
-        result = f'{{diff.days}}天{{diff.seconds//3600}}小时{{(diff.seconds%3600)//60}}分钟'
-    else:
-        result = '时间格式无效'
-except Exception as e:
-    result = f'时间差计算错误: {{e}}'
-"""
-            return "result = '时间格式无效'"
-            
-        # 6. 变量操作宏（统一作用域感知）
-        elif macro_name == 'getvar':
-            return f"result = getvar('{params}')"
-        
-        elif macro_name == 'setvar':
-            if '::' in params:
-                parts = params.split('::', 1)
-                if len(parts) >= 2:
-                    var_name, value = parts[0].strip(), parts[1].strip()
-                    return f"result = setvar('{var_name}', '{value}')"
-            return "result = ''"
-        
-        elif macro_name == 'addvar':
-            if '::' in params:
-                parts = params.split('::', 1)
-                if len(parts) >= 2:
-                    var_name, increment = parts[0].strip(), parts[1].strip()
-                    return f"result = addvar('{var_name}', '{increment}')"
-            return "result = ''"
-        
-        elif macro_name == 'incvar':
-            return f"result = incvar('{params}')"
-        
-        elif macro_name == 'decvar':
-            return f"result = decvar('{params}')"
-        
-        # 7. 全局变量操作宏
-        elif macro_name == 'getglobalvar':
-            return f"result = getglobalvar('{params}')"
-        
-        elif macro_name == 'setglobalvar':
-            if '::' in params:
-                parts = params.split('::', 1)
-                if len(parts) >= 2:
-                    var_name, value = parts[0].strip(), parts[1].strip()
-                    return f"result = setglobalvar('{var_name}', '{value}')"
-            return "result = ''"
-            
-        elif macro_name == 'addglobalvar':
-            if '::' in params:
-                parts = params.split('::', 1)
-                if len(parts) >= 2:
-                    var_name, value = parts[0].strip(), parts[1].strip()
-                    return f"""
-try:
-    current = getglobalvar('{var_name}', '0')
-    if current.isdigit() and '{value}'.isdigit():
-        result = str(int(current) + int('{value}'))
-        setglobalvar('{var_name}', result)
-    else:
-        try:
-            result = str(float(current) + float('{value}'))
-            setglobalvar('{var_name}', result)
-        except ValueError:
-            result = current + '{value}'  # 非数字则拼接字符串
-            setglobalvar('{var_name}', result)
-except Exception as e:
-    result = f'错误: {{e}}'
-"""
-            return "result = '参数不足'"
-            
-        elif macro_name == 'incglobalvar':
-            return f"""
-try:
-    current = getglobalvar('{params}', '0')
-    if current.isdigit():
-        result = str(int(current) + 1)
-    else:
-        try:
-            result = str(float(current) + 1)
-        except ValueError:
-            result = '1'  # 无法转换为数字则重置为1
-    setglobalvar('{params}', result)
-except Exception as e:
-    result = f'错误: {{e}}'
-"""
-
-        elif macro_name == 'decglobalvar':
-            return f"""
-try:
-    current = getglobalvar('{params}', '0')
-    if current.isdigit():
-        result = str(int(current) - 1)
-    else:
-        try:
-            result = str(float(current) - 1)
-        except ValueError:
-            result = '-1'  # 无法转换为数字则重置为-1
-    setglobalvar('{params}', result)
-except Exception as e:
-    result = f'错误: {{e}}'
-"""
+    def _get_time_macro_code(self, macro_content: str, macro_name: str, params: str) -> str:
+        """时间相关宏在转换时就计算了时间，只在同一秒内复用转换结果"""
+        now = self._render_now
+        if now is None or '%f' in params:
+            return self._convert_traditional_macro_to_python(macro_name, params)
         
-        # 8. 日期时间格式化
-        elif macro_name == 'datetimeformat':
-            # 这里可以添加日期格式化逻辑
-            return f"result = datetime.now().strftime('{params}')"
+        second = now.replace(microsecond=0)
+        if second != self._time_macro_second:
+            self._time_macro_cache.clear()
+            self._time_macro_second = second
+        python_code = self._time_macro_cache.get(macro_content)
+        if python_code is None:
+            python_code = self._convert_traditional_macro_to_python(macro_name, params)
+            self._time_macro_cache[macro_content] = python_code
+        return python_code
+    
+    def _convert_traditional_macro_to_python(self, macro_name: str, params: str) -> str:
+        """将传统宏转换为Python代码"""
+        # 日期时间格式化 / 时区相关（使用本次渲染的时间快照）
+        if macro_name == 'datetimeformat':
+            return _convert_datetimeformat(params, self._render_now or datetime.now())
+        if macro_name.startswith('time_UTC'):
+            return _convert_time_utc(macro_name, self._render_now or datetime.now())
         
-        # 9. 时区相关
-        elif macro_name.startswith('time_UTC'):
-            # 提取UTC偏移值
-            try:
-                offset_str = macro_name[8:]  # 提取"time_UTC"后面的部分
-                if offset_str:
-                    offset = int(offset_str)  # 转换为整数
-                    # 计算指定时区的时间
-                    utc_time = datetime.now()
-                    target_time = utc_time + timedelta(hours=offset)
-                    return f"result = '{target_time.strftime('%H:%M:%S')}'"
-                else:
-                    return "result = datetime.now().strftime('%H:%M:%S')"
-            except ValueError:
-                # 偏移值无效，返回当前时间
-                return "result = datetime.now().strftime('%H:%M:%S')"
-        
-        # 未知宏
-        else:
-            return ""  # 返回空字符串表示无法转换
+        return _convert_static_macro(macro_name, params)
     
     def _clean_macro_artifacts(self, content: str) -> str:
         """清理宏处理后的空白和格式问题"""
         if not content:
             return ""
         
+        # 单行内容无需逐行处理
+        if '\n' not in content:
+            return content if content.strip() else ""
+        
         # 移除多余的空行
         lines = content.split('\n')
         cleaned_lines = []
@@ -670,12 +1095,18 @@ except Exception as e:
     
     def update_context(self, **kwargs):
         """更新执行上下文"""
+        updated_fields = set()
         for key, value in kwargs.items():
             if hasattr(self.context, key):
                 setattr(self.context, key, value)
+                updated_fields.add(key)
         
-        # 重新注入上下文变量
-        self._inject_context_variables()
+        # 上下文没有变化时无需重新注入
+        if not updated_fields:
+            return
+        
+        # 只重新注入变化字段对应的上下文变量
+        self._inject_context_variables(updated_fields)
     
     def get_all_variables(self) -> Dict[str, Dict[str, Any]]:
         """获取所有作用域的变量状态"""
@@ -697,13 +1128,13 @@ except Exception as e:
             return {"success": False, "error": "沙盒不可用"}
         
         # 设置当前作用域
-        self.sandbox.execute_code(f"globals()['_current_scope'] = '{scope_type}'", scope_type='global')
+        self._current_scope = scope_type
         
-        result = self.sandbox.execute_code(code, scope_type=scope_type)
+        success, value, error = self._run_in_sandbox(code, scope_type)
         return {
-            "success": result.success,
-            "result": result.result,
-            "error": result.error
+            "success": success,
+            "result": value,
+            "error": error
         }
     
     def process_messages_sequentially(self, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
@@ -726,6 +1157,11 @@ except Exception as e:
         processed_messages = []
         
         for msg in messages:
+            # 不含宏、代码块和动态enabled的消息直接复制，跳过逐步处理
+            if not _needs_macro_processing(msg):
+                processed_messages.append(msg.copy())
+                continue
+            
             try:
                 # 确定当前消息的作用域
                 scope_type = self._determine_message_scope(msg)
@@ -775,8 +1211,6 @@ except Exception as e:
         - Step 3: content处理 - 处理传统宏、Python宏等
         - Step 4: 变量状态更新 - 共享沙盒自动实现，后续词条可见最新状态
         """
-        processed_msg = message.copy()
-        
         # Step 1: enabled评估 - 使用当前最新的变量状态评估
         enabled = message.get('enabled', True)
         if enabled != True and enabled != False:
@@ -804,6 +1238,8 @@ except Exception as e:
                 print(f"⚠️ 代码块执行异常: {e}")
         
         # Step 3: content处理 - 处理传统宏、Python宏等
+        # 被禁用的消息在上面已直接返回，只为保留的消息复制一次
+        processed_msg = message.copy()
         if 'content' in processed_msg:
             processed_msg['content'] = self.process_content(processed_msg['content'], scope_type)
         
@@ -839,16 +1275,16 @@ except Exception as e:
             # 如果不是明显的Python代码，包装成表达式
             if not any(keyword in processed_expr for keyword in ['and', 'or', 'not', '==', '!=', '>', '<', 'getvar', 'True', 'False']):
                 # 简单的变量名或值，尝试直接获取
-                python_code = f"result = bool(getvar('{processed_expr}'))"
+                python_code = f"result = bool(getvar({processed_expr!r}))"
             else:
                 # 复杂表达式，直接计算
                 python_code = f"result = bool({processed_expr})"
             
-            exec_result = self.sandbox.execute_code(python_code, scope_type=scope_type)
-            if exec_result.success:
-                return bool(exec_result.result)
+            success, value, error = self._run_in_sandbox(python_code, scope_type)
+            if success:
+                return bool(value)
             else:
-                print(f"⚠️ enabled 表达式计算失败: {exec_result.error}")
+                print(f"⚠️ enabled 表达式计算失败: {error}")
                 return True  # 默认启用
                 
         except Exception as e:
@@ -858,12 +1294,13 @@ except Exception as e:
 
 def create_unified_macro_processor(character_data: Dict[str, Any] = None,
                                  persona_data: Dict[str, Any] = None,
-                                 chat_history: List[Any] = None) -> UnifiedMacroProcessor:
-    """创建统一宏处理器的便捷函数"""
+                                 chat_history: List[Any] = None,
+                                 sandbox: Optional[PythonSandbox] = None) -> UnifiedMacroProcessor:
+    """创建统一宏处理器的便捷函数（可传入共享沙盒）"""
     context = MacroExecutionContext(
         character_data=character_data or {},
         persona_data=persona_data or {},
         chat_history=chat_history or []
     )
     
-    return UnifiedMacroProcessor(context)
+    return UnifiedMacroProcessor(context, sandbox=sandbox)